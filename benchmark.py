@@ -0,0 +1,506 @@
+# Benchmarks of the main functions of data.py on synthetic stations, so no connection is needed.
+# Usage:
+#   python benchmark.py                         the comparisons of the different implementations
+#   python benchmark.py suite [--output FILE]   the scaling of every entry point, stored as JSON
+#   python benchmark.py compare OLD NEW         the changes between two results of the suite
+#   python benchmark.py imports                 the time of importing the modules, within budget
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+import data as dt
+import feed
+import render
+import history
+import forecast
+
+
+# Returns a dataframe of n random stations spread over Barcelona.
+def synthetic_stations(n=500, seed=0):
+    rng = np.random.default_rng(seed)
+    index = pd.Index(np.arange(1, n + 1), name='station_id')
+    return pd.DataFrame({"lat": rng.uniform(41.35, 41.45, n), "lon": rng.uniform(2.10, 2.22, n)}, index=index)
+
+
+# Returns a dataframe of n random stations as dense as the ones of Barcelona (500 of them in the
+# area of synthetic_stations), spread over a larger area around it when there are more.
+def city_stations(n=500, seed=0):
+    rng = np.random.default_rng(seed)
+    scale = np.sqrt(n / 500)
+    index = pd.Index(np.arange(1, n + 1), name='station_id')
+    lat = 41.40 + rng.uniform(-0.05, 0.05, n) * scale
+    lon = 2.16 + rng.uniform(-0.06, 0.06, n) * scale
+    return pd.DataFrame({"lat": lat, "lon": lon}, index=index)
+
+
+# Returns a dataframe with a random number of bikes and docks for every given station.
+def synthetic_bikes(stations, capacity=27, seed=0):
+    rng = np.random.default_rng(seed)
+    bikes = rng.integers(0, capacity + 1, len(stations))
+    return pd.DataFrame({"num_bikes_available": bikes, "num_docks_available": capacity - bikes}, index=stations.index)
+
+
+# Returns n random pairs of coordinates in Barcelona.
+def random_queries(n, seed=0):
+    rand = random.Random(seed)
+    point = lambda: (rand.uniform(41.35, 41.45), rand.uniform(2.10, 2.22))
+    return [(point(), point()) for _ in range(n)]
+
+
+# Returns the mean time (in ms) taken by compute_path over the given queries.
+def time_queries(G, queries):
+    t = time.perf_counter()
+    for start, finish in queries:
+        dt.compute_path(G, start, finish)
+    return (time.perf_counter() - t) * 1000 / len(queries)
+
+
+# Compares the routing of the Dijkstra search with the one of the precomputed tables and the one
+# of the lazy graphs, which build no graph at all.
+def bench_routing(n=500, dists=(500, 1000, 2000, 3000), n_queries=200):
+    stations = synthetic_stations(n)
+    index = dt.StationIndex(stations)
+    queries = random_queries(n_queries)
+    print("Routing with", n, "stations (mean ms per query)")
+    print("distance  edges  dijkstra  precompute(ms)  indexed     lazy")
+    for dist in dists:
+        G = dt.build_graph(dist, stations=stations)
+        dijkstra = time_queries(G, queries)
+
+        t = time.perf_counter()
+        dt.add_routing_index(G)
+        precompute = (time.perf_counter() - t) * 1000
+        indexed = time_queries(G, queries)
+        lazy = time_queries(dt.LazyGraph(index, dist), queries)
+
+        print("%8d %6d %9.3f %15.1f %8.3f %8.3f" % (dist, G.number_of_edges(), dijkstra, precompute, indexed, lazy))
+
+
+# Compares building a graph again with updating it when a few stations appear, disappear or move.
+def bench_update(n=500, dists=(500, 1000, 3000), changes=5):
+    stations = synthetic_stations(n)
+    new = synthetic_stations(n + changes, seed=1).iloc[n:]  # the stations that appear
+    updated = pd.concat([stations.iloc[changes:], new])  # the first ones disappear
+    updated.iloc[:changes, 0] += 0.002  # and some others move
+
+    print("Updating", changes * 3, "of", n, "stations (ms)")
+    print("distance  edges  rebuild  update")
+    for dist in dists:
+        t = time.perf_counter()
+        dt.build_graph(dist, stations=updated)
+        rebuild = (time.perf_counter() - t) * 1000
+
+        G = dt.build_graph(dist, stations=stations)
+        t = time.perf_counter()
+        dt.build_graph(dist, G, stations=updated, previous=stations)
+        update = (time.perf_counter() - t) * 1000
+
+        print("%8d %6d %8.1f %7.1f" % (dist, G.number_of_edges(), rebuild, update))
+
+
+# Returns the result of func(*args), the time it took (in ms) and the memory it allocated (in KB).
+def measure(func, *args, **kwargs):
+    tracemalloc.start()
+    t = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = (time.perf_counter() - t) * 1000
+    memory = tracemalloc.get_traced_memory()[0] / 1024
+    tracemalloc.stop()
+    return result, elapsed, memory
+
+
+# Compares the build time and memory of the networkx graphs and the array-backed StationGraphs.
+def bench_backends(n=500, dists=(500, 1000, 2000, 3000, 5000)):
+    stations = synthetic_stations(n)
+    pairs = dt.PairTable(stations)
+    print("Graph backends with", n, "stations")
+    print("distance  edges  networkx(ms)  networkx(KB)  csr(ms)  csr(KB)")
+    for dist in dists:
+        G, nx_time, nx_memory = measure(dt.build_graph, dist, stations=stations, pairs=pairs)
+        H, csr_time, csr_memory = measure(dt.build_station_graph, dist, stations=stations, pairs=pairs)
+        print("%8d %6d %13.1f %13.0f %8.1f %8.0f" % (dist, G.number_of_edges(), nx_time, nx_memory, csr_time, csr_memory))
+
+
+# Compares the ways of solving the minimum cost flow of minflow: the whole network with each solver
+# and the reduced one (see data.reduced_network), checking that all of them find the same cost.
+def bench_flow(n=500, dists=(500, 1000, 2000, 3000), demands=((1, 1), (2, 2), (5, 5))):
+    stations = synthetic_stations(n)
+    bikes = synthetic_bikes(stations)
+    methods = [("network_simplex", False), ("highs", False), ("highs", True)]
+    print("Solvers of the distribution with", n, "stations (ms)")
+    print("distance  demand  network_simplex   highs  reduced  speedup  cost")
+    for dist in dists:
+        for demand in demands:
+            times, costs = [], set()
+            for solver, reduced in methods:
+                t = time.perf_counter()
+                try:
+                    info = dt.minflow(demand, dist, (stations, bikes.copy()), solver, reduced)
+                except ValueError as e:
+                    info = e.args[0]
+                times.append((time.perf_counter() - t) * 1000)
+                costs.add(info.split("\n")[0])
+
+            if len(costs) > 1:
+                raise AssertionError("Different costs: " + ", ".join(costs))
+            print("%8d %7s %16.1f %7.1f %8.1f %7.1fx  %s" % (dist, demand, times[0], times[1], times[2],
+                                                             times[0] / times[2], costs.pop()))
+
+
+# Compares a sweep of distribute_sweep with solving every scenario of it on its own with minflow.
+def bench_sweep(n=500, dists=(300, 500, 700, 1000, 1300, 1600, 2000, 2500, 3000, 4000), n_demands=10):
+    stations = synthetic_stations(n)
+    bikes = synthetic_bikes(stations)
+    demands = [(x, x) for x in range(1, n_demands + 1)]
+
+    t = time.perf_counter()
+    dt.distribute_sweep(demands, dists, (stations, bikes))
+    sweep = (time.perf_counter() - t) * 1000
+
+    t = time.perf_counter()
+    for demand in demands:
+        for dist in dists:
+            try:
+                dt.minflow(demand, dist, (stations, bikes.copy()))
+            except ValueError:
+                pass
+    single = (time.perf_counter() - t) * 1000
+
+    print("Sweep of", len(demands), "demands and", len(dists), "distances with", n, "stations (ms)")
+    print("sweep %.1f   one by one %.1f" % (sweep, single))
+
+
+# Appends "days" days of the status of n stations, polled every 30 seconds, to a history and
+# queries it, measuring the time of every append and query and the size of the history.
+def bench_history(n=500, days=2, interval=30):
+    stations = synthetic_stations(n)
+    rng = np.random.default_rng(0)
+    bikes = synthetic_bikes(stations)
+    start = 1700000000
+    times = range(start, start + days * 24 * 3600, interval)
+    with tempfile.TemporaryDirectory() as directory:
+        status_history = history.StatusHistory(directory)
+        append = 0
+        for now in times:
+            changed = rng.random(n) < 0.05
+            bikes.loc[changed, "num_bikes_available"] = rng.integers(0, 28, changed.sum())
+            bikes["num_docks_available"] = 27 - bikes["num_bikes_available"]
+            t = time.perf_counter()
+            status_history.append(now, bikes)
+            append += time.perf_counter() - t
+        append = append / len(times) * 1e6
+        status_history.close()
+
+        t = time.perf_counter()
+        dt.history_aggregates(status_history, window=3600)
+        hourly = (time.perf_counter() - t) * 1000
+        t = time.perf_counter()
+        dt.history_aggregates(status_history, start + 3600, start + 7 * 3600, window=None)
+        window = (time.perf_counter() - t) * 1000
+        t = time.perf_counter()
+        dt.station_history(status_history, stations.index[0])
+        station = (time.perf_counter() - t) * 1000
+
+        print("History of", n, "stations over", days, "days every", interval, "s:", len(times), "rows,",
+              status_history.nbytes() // 1024, "KB")
+        print("append %.0f us   hourly aggregates %.1f ms   6 hours %.1f ms   one station %.1f ms" %
+              (append, hourly, window, station))
+
+
+# Returns the bikes of the stations at the given unix times (a row per time) following a weekly
+# pattern: some stations empty in the mornings of the working days and fill in the evenings
+# (homes) and others the opposite (offices), weaker on the weekends, plus noise.
+def synthetic_pattern(stations, times, capacity=27, seed=0):
+    rng = np.random.default_rng(seed)
+    n = len(stations)
+    kind = np.random.default_rng(1).uniform(-1, 1, n)  # the same for every seed
+    hours = (np.asarray(times) % (24 * 3600)) / 3600
+    weekend = ((np.asarray(times) // (24 * 3600) + 3) % 7) >= 5  # the 1st of January of 1970 was a Thursday
+    strength = np.where(weekend, 0.3, 1.0)
+    wave = np.sin(2 * np.pi * (hours - 10) / 24) * strength
+    level = capacity / 2 + np.outer(wave, kind) * capacity * 0.4 + rng.normal(0, 1.5, (len(times), n))
+    return np.clip(np.rint(level), 0, capacity).astype(int)
+
+
+# Writes a synthetic history of the given stations in the directory, their status every
+# "interval" seconds for the "days" days before the unix time "end", following synthetic_pattern.
+# Returns the history.
+def synthetic_history(directory, stations, days=28, interval=300, end=1700000000, capacity=27, seed=0):
+    times = np.arange(end - days * 24 * 3600, end, interval)
+    bikes = synthetic_pattern(stations, times, capacity, seed)
+    status_history = history.StatusHistory(directory, days + 1)
+    for now, row in zip(times, bikes):
+        status = pd.DataFrame({"num_bikes_available": row, "num_docks_available": capacity - row},
+                              index=stations.index)
+        status_history.append(now, status)
+    status_history.close()
+    return status_history
+
+
+# Fits the seasonal baseline on a synthetic history and compares its forecasts with keeping
+# the current bikes, on the following day.
+def bench_forecast(n=500, days=28, interval=300, minutes=(30, 60, 120)):
+    stations = synthetic_stations(n)
+    with tempfile.TemporaryDirectory() as directory:
+        end = 1700000000
+        status_history = synthetic_history(directory, stations, days, interval, end)
+        baseline = forecast.SeasonalBaseline()
+        t = time.perf_counter()
+        baseline.update(status_history)
+        fit = (time.perf_counter() - t) * 1000
+
+        # The next day, which is not in the history
+        times = np.arange(end, end + 24 * 3600, 1800)
+        print("Forecast of", n, "stations with", days, "days of history every", interval, "s: fitted in %.0f ms" % fit)
+        for ahead in minutes:
+            both = synthetic_pattern(stations, np.append(times, times + ahead * 60), seed=ahead)
+            now, later = both[:len(times)], both[len(times):]
+            errors, naive = [], []
+            for t, current, actual in zip(times, now, later):
+                bikes = pd.DataFrame({"num_bikes_available": current, "num_docks_available": 27 - current},
+                                     index=stations.index)
+                predicted = baseline.predict(bikes, t, ahead)["num_bikes_available"].to_numpy()
+                errors.append(np.abs(predicted - actual).mean())
+                naive.append(np.abs(current - actual).mean())
+            print("%4d minutes ahead: mean error %.2f bikes, keeping the current ones %.2f" %
+                  (ahead, np.mean(errors), np.mean(naive)))
+
+
+# The sizes (number of stations) and distances (in meters) of the suite by default.
+SUITE_SIZES = (500, 5000, 50000)
+SUITE_DISTS = (250, 500, 1000, 2000)
+
+# The entry points that are only measured up to the given number of stations, since they
+# would take minutes or more with more of them.
+SUITE_LIMITS = {"draw_graph": 5000, "minflow": 5000}
+
+
+# Writes the GBFS feeds of n synthetic stations (see city_stations) in the given directory,
+# with the fields of the real ones that the bot reads and a few others.
+def synthetic_feeds(directory, n, seed=0):
+    stations = city_stations(n, seed)
+    bikes = synthetic_bikes(stations, seed=seed)
+    information = stations.assign(name=["Station " + str(idx) for idx in stations.index], capacity=27)
+    status = bikes.assign(is_renting=1, is_returning=1, last_reported=int(time.time()))
+    feed.write_feeds(directory, information, status)
+
+
+# Returns the time (in ms) that func(*args) takes and the peak of memory (in KB) it allocates.
+# They are measured in separate runs, as tracing the memory slows the code down. The time is
+# the best of up to "repeat" runs, as long as they take less than a second in total.
+def profile(func, *args, memory=True, repeat=3):
+    times = []
+    while len(times) < repeat and sum(times) < 1000:
+        t = time.perf_counter()
+        func(*args)
+        times.append((time.perf_counter() - t) * 1000)
+    elapsed = min(times)
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+# Returns the results of every entry point of data.py on the synthetic feeds of every size,
+# read through a local feed server, and for every distance: the time, the peak of memory and
+# the edges of the graph. The time of compute_path is the one of all the n_queries routes, and
+# the one of available_path of the same routes from a station with bikes to one with docks.
+def run_suite(sizes=SUITE_SIZES, dists=SUITE_DISTS, n_queries=20, memory=True, log=print):
+    render.OFFLINE = True  # no tiles are downloaded
+    queries = random_queries(n_queries)
+    results = []
+
+    def record(name, n, dist, func, *args, edges=None):
+        if n > SUITE_LIMITS.get(name, n):
+            return
+        elapsed, peak = profile(func, *args, memory=memory)
+        results.append({"name": name, "stations": n, "dist": dist, "ms": elapsed, "peak_kb": peak, "edges": edges})
+        log("%-14s %6d %6s %10.1f ms %12s KB %9s edges" % (name, n, "-" if dist is None else dist, elapsed,
+                                                          "-" if peak is None else "%.0f" % peak,
+                                                          "-" if edges is None else edges))
+
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            synthetic_feeds(directory, n)
+            server = feed.FakeFeedServer(directory)
+            poll = lambda: feed.FeedPoller(url=server.url).poll()
+            record("load_feeds", n, None, poll)
+            snapshot = poll()
+            server.shutdown()
+            server.server_close()
+
+        stations, bikes = snapshot.stations, snapshot.bikes
+        record("pair_table", n, None, dt.PairTable, stations)
+        index = dt.StationIndex(stations)
+        origins = index.available(bikes, "num_bikes_available")
+        destinations = index.available(bikes, "num_docks_available")
+        for dist in dists:
+            G = dt.build_graph(dist, stations=stations)
+            edges = G.number_of_edges()
+            record("build_graph", n, dist, lambda: dt.build_graph(dist, stations=stations), edges=edges)
+            record("station_graph", n, dist, lambda: dt.build_station_graph(dist, stations), edges=edges)
+            record("compute_path", n, dist, lambda: [dt.compute_path(G, *query) for query in queries], edges=edges)
+            record("available_path", n, dist, lambda: [dt.compute_path(dt.LazyGraph(index, dist), *query, origins,
+                                                                       destinations) for query in queries], edges=edges)
+            record("minflow", n, dist, lambda: minflow_or_impossible((2, 2), dist, stations, bikes), edges=edges)
+            record("draw_graph", n, dist, dt.draw_graph, G, edges=edges)
+    return results
+
+
+# Runs minflow on a copy of the bikes, as an impossible distribution takes its time as well.
+def minflow_or_impossible(demand, dist, stations, bikes):
+    try:
+        return dt.minflow(demand, dist, (stations, bikes.copy()))
+    except ValueError:
+        return "impossible"
+
+
+# Returns the description of the code and the machine the suite runs on.
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {"commit": commit or None, "python": platform.python_version(), "machine": platform.machine(),
+            "processor": platform.processor(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+# Prints the time and memory of every result of "new" relative to the same one in "old", marking
+# the ones that are slower or larger by more than the given ratio. Returns the number of them.
+def compare(old, new, threshold=1.2):
+    key = lambda result: (result["name"], result["stations"], result["dist"])
+    previous = {key(result): result for result in old["results"]}
+    print("Comparing", old["environment"].get("commit"), "with", new["environment"].get("commit"))
+    print("%-14s %6s %6s %10s %8s %10s %8s" % ("name", "n", "dist", "ms", "ratio", "peak KB", "ratio"))
+
+    regressions = 0
+    for result in new["results"]:
+        before = previous.get(key(result))
+        if before is None:
+            continue
+        line = "%-14s %6d %6s %10.1f %7.2fx" % (result["name"], result["stations"],
+                                                "-" if result["dist"] is None else result["dist"], result["ms"],
+                                                result["ms"] / max(before["ms"], 1e-9))
+        worse = result["ms"] > before["ms"] * threshold
+        if result["peak_kb"] is not None and before["peak_kb"] is not None:
+            line += " %10.0f %7.2fx" % (result["peak_kb"], result["peak_kb"] / max(before["peak_kb"], 1e-9))
+            worse = worse or result["peak_kb"] > before["peak_kb"] * threshold
+        if worse:
+            regressions += 1
+            line += "  <- worse"
+        print(line)
+    print(regressions, "results are worse by more than", threshold, "times")
+    return regressions
+
+
+# The time (in ms) that importing each module may take in a new interpreter: what the workers of
+# the pool (data) and the bot (bot) pay before doing anything. The libraries that only some
+# commands need must not be imported by them (see data.py).
+IMPORT_BUDGETS = {"data": 800, "bot": 1000}
+DEFERRED_IMPORTS = ("staticmap", "geopy", "scipy.optimize", "scipy.spatial", "PIL")
+
+
+# Returns the time (in ms) of importing the module in a new interpreter, the time of each module
+# it imports directly, and the names of all the modules imported, measured with -X importtime.
+def import_time(module):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    children, imported = dict(), set()
+    for line in result.stderr.splitlines():
+        fields = line[len("import time:"):].split("|")
+        if not line.startswith("import time:") or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        # Every module is listed after the ones it imports, so these are the ones of the last
+        # module imported directly by the interpreter
+        if depth == 0 and name == module:
+            return int(fields[1]) / 1000, children, imported | {name}
+        if depth == 0:
+            children, imported = dict(), set()
+        else:
+            imported.add(name)
+            if depth == 1:
+                children[name] = int(fields[1]) / 1000
+    raise ValueError("the import of " + module + " was not measured")
+
+
+# Prints the time of importing every module of IMPORT_BUDGETS (the best of "repeat" runs) and
+# the slowest modules it imports. Returns the number of modules over their budget or importing
+# some of DEFERRED_IMPORTS.
+def check_imports(budgets=IMPORT_BUDGETS, repeat=3):
+    failures = 0
+    for module, budget in budgets.items():
+        runs = [import_time(module) for _ in range(repeat)]
+        total, children, imported = min(runs, key=lambda run: run[0])
+        slowest = sorted(children.items(), key=lambda item: -item[1])[:5]
+        print("%-6s %7.1f ms (budget %d ms): %s" % (module, total, budget,
+                                                   ", ".join("%s %.0f" % item for item in slowest)))
+        deferred = [name for name in DEFERRED_IMPORTS if name in imported]
+        if deferred:
+            print("       imports", ", ".join(deferred), "at once")
+        if total > budget or deferred:
+            failures += 1
+    return failures
+
+
+# Runs the micro benchmarks of the different implementations.
+def run_micro():
+    bench_routing()
+    bench_update()
+    bench_backends()
+    bench_flow()
+    bench_sweep()
+    bench_history()
+    bench_forecast()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the bot on synthetic data.")
+    commands = parser.add_subparsers(dest="command")
+    suite = commands.add_parser("suite", help="measure every entry point across sizes and distances")
+    suite.add_argument("--sizes", type=int, nargs="+", default=SUITE_SIZES)
+    suite.add_argument("--dists", type=int, nargs="+", default=SUITE_DISTS)
+    suite.add_argument("--queries", type=int, default=20, help="routes computed per graph")
+    suite.add_argument("--no-memory", action="store_true", help="do not measure the peak of memory")
+    suite.add_argument("--output", help="JSON file where the results are stored")
+    versus = commands.add_parser("compare", help="compare two JSON files of the suite")
+    versus.add_argument("old")
+    versus.add_argument("new")
+    versus.add_argument("--threshold", type=float, default=1.2)
+    imports = commands.add_parser("imports", help="check the time of importing the modules")
+    imports.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    if args.command == "suite":
+        results = run_suite(args.sizes, args.dists, args.queries, not args.no_memory)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"environment": environment(), "results": results}, f, indent=1)
+    elif args.command == "compare":
+        with open(args.old) as f, open(args.new) as g:
+            return 1 if compare(json.load(f), json.load(g), args.threshold) else 0
+    elif args.command == "imports":
+        return 1 if check_imports(repeat=args.repeat) else 0
+    else:
+        run_micro()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
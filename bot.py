@@ -1,12 +1,153 @@
 import data as dt
+import cache
+import feed
+import render
+import metrics
+import sessions
+import history
+import forecast
 import telegram
 from telegram.ext import Updater
 from telegram.ext import CommandHandler
-import networkx as nx
+from telegram.ext.dispatcher import run_async
 import re
+import os
+import time
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import wraps
+from collections import deque
+
+
+# Number of threads of the dispatcher, i.e. commands attended at the same time.
+WORKERS = 8
+
+# Number of CPU-bound jobs (building graphs, distributing, drawing) run at the same time.
+MAX_HEAVY = 2
+
+# Number of CPU-bound jobs of the commands that may wait for a free process. The commands that
+# need more are turned down, so that the threads of the dispatcher waiting for the processes are
+# never more than MAX_HEAVY + MAX_QUEUED_HEAVY and the rest are left to the cheap commands.
+MAX_QUEUED_HEAVY = 2
+
+# The answer to the commands turned down.
+BUSY = "The bot is busy, please try again in a moment"
+
+# The processes that run the CPU-bound jobs, created when the first one arrives.
+heavy_pool = None
+heavy_lock = threading.Lock()
+heavy_slots = threading.BoundedSemaphore(MAX_HEAVY + MAX_QUEUED_HEAVY)
+
+# The commands of every user waiting to be attended, one at a time and in order (see serialized).
+# A user is in it while some thread is attending its commands.
+pending = dict()
+pending_lock = threading.Lock()
+
+# The state of every user: the chosen distance, the snapshot of the data the graph is built on
+# and, once /distribute has modified them, the user's own bikes of the stations.
+dict_graphs = dict()
 
+# Where the sessions are saved to be restored after a restart (see restore), if anywhere.
+store = None
 
-dict_graphs = dict()
+# The history of the status of the stations, where every new snapshot is kept (see keep_history),
+# and the seasonal baseline fitted on it, which forecasts the bikes for /distribute.
+status_history = None
+baseline = forecast.SeasonalBaseline()
+
+# The maximum number of minutes ahead that /distribute forecasts.
+MAX_FORECAST = 24 * 60
+
+# The maximum number of stations that /nearest lists.
+MAX_NEAREST = 20
+
+# Runs func(*args, **kwargs) in the pool of processes and returns its result. If there are
+# already too many jobs waiting, it raises ValueError unless "wait" is set, then it waits for
+# a free slot (only for threads that are not the dispatcher's, see HeavyExecutor).
+def run_heavy(func, *args, wait=False, **kwargs):
+    global heavy_pool
+    if not heavy_slots.acquire(blocking=wait):
+        metrics.count("bicing_heavy_rejected_total", job=func.__name__)
+        raise ValueError(BUSY)
+    try:
+        with heavy_lock:
+            if heavy_pool is None:
+                heavy_pool = ProcessPoolExecutor(MAX_HEAVY, mp_context=multiprocessing.get_context("spawn"))
+        with metrics.timed("bicing_heavy_seconds", job=func.__name__):
+            result, recorded = heavy_pool.submit(metrics.collect, func, *args, **kwargs).result()
+        metrics.merge(recorded)  # what the job measured in its process
+        return result
+    finally:
+        heavy_slots.release()
+
+
+# Submits CPU-bound jobs to the pool of processes like an executor, without waiting for them,
+# so that the independent parts of a command (e.g. the scenarios of /distributesweep) run in parallel.
+class HeavyExecutor:
+
+    def __init__(self):
+        self.threads = ThreadPoolExecutor(MAX_HEAVY)
+
+    def submit(self, func, *args, **kwargs):
+        return self.threads.submit(run_heavy, func, *args, wait=True, **kwargs)
+
+
+heavy_executor = HeavyExecutor()
+
+# The ids of the users allowed to see /stats, separated by commas in BICING_ADMINS.
+ADMINS = set(int(usr_id) for usr_id in os.environ.get("BICING_ADMINS", "").split(",") if usr_id.strip())
+
+# The maximum number of scenarios (demands times distances) of /distributesweep.
+MAX_SWEEP = 100
+
+
+# The graphs, shared by all the users with the same snapshot and distance. They are kept as
+# data.StationGraphs, memory-mapped from the state directory (see restore), so the processes of
+# cluster.py share them, and /route searches on the lazy graphs, which take the edges from them.
+graph_cache = cache.GraphCache(station_graphs=True)
+
+# Downloads the data on the background and keeps the latest snapshot, given to the new users.
+# Created by main (or cluster.run_worker), so that importing the bot does not set it up.
+poller = None
+
+# The images most recently sent, by the graph or the path they show.
+image_cache = render.ImageCache()
+
+# Size (in pixels) of the images sent.
+IMAGE_SIZE = 600
+
+
+# Makes the handler run in a thread of the dispatcher, after the previous commands of the same user.
+# The commands are queued by user and a single thread attends the ones of every user, so a user
+# sending many commands takes one thread of the dispatcher and leaves the others to the rest.
+def serialized(handler):
+    @wraps(handler)
+    def wrapper(bot, update, *args, **kwargs):
+        usr_id = update.message.from_user["id"]
+        with pending_lock:
+            idle = usr_id not in pending
+            pending.setdefault(usr_id, deque()).append((handler, (bot, update) + args, kwargs))
+        if idle:
+            attend(usr_id)
+    return wrapper
+
+
+# Attends the queued commands of the given user until there are none left.
+@run_async
+def attend(usr_id):
+    while True:
+        with pending_lock:
+            if not pending[usr_id]:
+                del pending[usr_id]
+                return
+            handler, args, kwargs = pending[usr_id].popleft()
+        try:
+            with metrics.timed("bicing_command_seconds", command=handler.__name__):
+                handler(*args, **kwargs)
+        except Exception as e:  # the next commands are attended anyway
+            print(e)
 
 
 # Sends a message to the user through Telegram
@@ -19,6 +160,7 @@ def send_to_user(bot, message, idnum, markdown=False):
 
 # Sends an error message
 def send_error(bot, error, idnum):
+    metrics.count("bicing_errors_total")
     print(error)  # Prints the error on the terminal window as well.
     print(idnum)
     try:
@@ -33,6 +175,72 @@ def check_id(id):
         raise ValueError("No graph has been created yet")
 
 
+# Returns the latest snapshot of the data.
+def latest_snapshot():
+    return poller.get_snapshot()
+
+
+# Returns the graph of the given user, building it if needed.
+def user_graph(usr_id):
+    session = dict_graphs[usr_id]
+    return graph_cache.get(session["snapshot"], session["dist"])
+
+
+# Assigns a graph with the given distance and snapshot to the user. It is not built until
+# some command needs all of it.
+def set_graph(usr_id, dist, snap, bikes=None):
+    graph_cache.register(snap, dist)
+    if usr_id in dict_graphs:
+        old = dict_graphs[usr_id]
+        graph_cache.release(old["snapshot"], old["dist"])
+    dict_graphs[usr_id] = {"dist": float(dist), "snapshot": snap, "bikes": bikes}
+    metrics.set_gauge("bicing_users", len(dict_graphs))
+    save_session(usr_id)
+
+
+# Saves the session of the given user, if the sessions are saved.
+def save_session(usr_id):
+    if store is not None:
+        store.save(usr_id, dict_graphs[usr_id])
+
+
+# Restores the sessions saved in the given directory, and from then on saves them there along
+# with the graphs of the cache. The graphs are read from disk when first needed, and the poller
+# starts from the latest snapshot, so no user needs to /start again nor wait for a download.
+# When several processes share the directory (see cluster.py), each one restores the users
+# for which owns(usr_id) is true, and only one of them deletes the files nobody uses.
+def restore(directory, owns=None, prune=True):
+    global store
+    store = sessions.SessionStore(directory)
+    graph_cache.store = os.path.join(directory, "graphs")
+
+    restored = store.load()
+    for usr_id, session in restored.items():
+        if owns is None or owns(usr_id):
+            graph_cache.register(session["snapshot"], session["dist"])
+            dict_graphs[usr_id] = session
+    metrics.set_gauge("bicing_users", len(dict_graphs))
+
+    if restored:
+        poller.snapshot = max((session["snapshot"] for session in restored.values()), key=lambda snap: snap.version)
+    if prune:
+        store.prune(restored)
+        graph_cache.prune_store(set(session["snapshot"].stations_version for session in restored.values()))
+
+
+# Keeps the status of every new snapshot of the poller in the history in the given directory,
+# for the given number of days, fitting the baseline of the forecasts on it as it grows. With
+# record=False the history is only read (e.g. by the workers of cluster.py that do not poll),
+# and the baseline is brought up to date when a forecast is needed.
+def keep_history(directory, days, record=True):
+    global status_history
+    status_history = history.StatusHistory(directory, days)
+    baseline.update(status_history)
+    if record:
+        poller.listeners.append(status_history.append_snapshot)
+        poller.listeners.append(lambda snap: baseline.update(status_history))
+
+
 # Returns error if the number of arguments is not the one expected
 def check_args(passed, expected, strictmax=True):
     if len(passed) > expected and strictmax:
@@ -42,6 +250,7 @@ def check_args(passed, expected, strictmax=True):
 
 
 # The default start function.
+@serialized
 def start(bot, update):
     try:
         send_to_user(bot, "A new graph created with distance 1000.\nAll commands are available now.", update.message.chat_id)
@@ -50,7 +259,7 @@ def start(bot, update):
         # Assign a new graph to the user
         global dict_graphs
         if usr_id not in dict_graphs:
-            dict_graphs[usr_id] = [dt.build_graph(), 1000, dt.get_dataframe(True)]  # store the graph, its radius and (stations, bikes that stations have)
+            set_graph(usr_id, 1000, latest_snapshot())
     except Exception as e:
         send_error(bot, "Error: " + e.args[0], update.message.chat_id)
 
@@ -66,56 +275,86 @@ def help(bot, update):
     - */nodes* : the number of nodes the graph currently has.
     - */components* : the number of connected components the graph currently has.
     - */plotgraph* : get an image of the current graph.
-    - */route* <_address #1_>, <_address #2_> : computes the shortest path between the given addresses.
-    - */distribute* <_bikes_>, <_docks_> : distributes the bikes to fit the demand
+    - */route* <_address #1_>, <_address #2_> [, <_threshold_>] : computes the shortest path between the given addresses, from a station with bikes to one with docks.
+    - */nearest* <_address_> [, [bikes|docks] [<_k_>]] : the k stations nearest to the address, with bikes or docks if asked
+    - */distribute* <_bikes_>, <_docks_> [<_minutes_>] : distributes the bikes to fit the demand, now or as forecast some minutes ahead
+    - */distributesweep* <_bikes_>,<_docks_> ... <_distance_> ... [chart] : the cost of distributing the bikes for every demand and distance
     '''
     bot.send_message(chat_id=update.message.chat_id, text=message, parse_mode=telegram.ParseMode.MARKDOWN)
 
 
 # Prints the number of edges of the current user's graph.
+@serialized
 def edges(bot, update):
     try:
         usr_id = update.message.from_user["id"]
         check_id(usr_id)
-        text = dt.number_edges(dict_graphs[usr_id][0])
+        session = dict_graphs[usr_id]
+        text = graph_cache.edges(session["snapshot"], session["dist"])
         send_to_user(bot, text, update.message.chat_id)
     except Exception as e:
         send_error(bot, "Error: " + e.args[0], update.message.chat_id)
 
 
 # Prints the number of nodes of the current user's graph.
+@serialized
 def nodes(bot, update):
     try:
         usr_id = update.message.from_user["id"]
         check_id(usr_id)
-        text = dt.number_nodes(dict_graphs[usr_id][0])
+        text = len(dict_graphs[usr_id]["snapshot"].stations)  # every station is a node
         send_to_user(bot, text, update.message.chat_id)
     except Exception as e:
         send_error(bot, "Error: " + e.args[0], update.message.chat_id)
 
 
 # Prints the number of connected components of the current user's graph.
+@serialized
 def components(bot, update):
     try:
         usr_id = update.message.from_user["id"]
         check_id(usr_id)
-        text = dt.number_components(dict_graphs[usr_id][0])
+        session = dict_graphs[usr_id]
+        text = graph_cache.components(session["snapshot"], session["dist"])
         send_to_user(bot, text, update.message.chat_id)
     except Exception as e:
         send_error(bot, "Error: " + e.args[0], update.message.chat_id)
 
 
+@serialized
 def plotgraph(bot, update):
     try:
         usr_id = update.message.from_user["id"]
         check_id(usr_id)
-        dt.draw_graph(dict_graphs[usr_id][0])
-        bot.send_photo(chat_id=update.message.chat_id, photo=open("stations.png", "rb"))
+        session = dict_graphs[usr_id]
+        key = ("graph", session["snapshot"].stations_version, session["dist"], IMAGE_SIZE)
+        image = image_cache.get(key)
+        if image is None:
+            image = run_heavy(dt.draw_graph, user_graph(usr_id), IMAGE_SIZE)
+            image_cache.put(key, image)
+        bot.send_photo(chat_id=update.message.chat_id, photo=image)
     except Exception as e:
         send_error(bot, "Error: " + e.args[0], update.message.chat_id)
 
 
-# Prints the shortest route between two given addresses.
+# Returns the stations the routes of the given user can start at, the ones with more bikes than
+# the threshold, and the ones they can end at, with more docks. They are the same for all the
+# users with the shared bikes of a snapshot, so they are kept in the cache; the ones of the bikes
+# modified by /distribute are found for every route.
+def route_stations(session, threshold=0):
+    snap = session["snapshot"]
+    if session["bikes"] is None:
+        return (graph_cache.available_stations(snap, "num_bikes_available", threshold),
+                graph_cache.available_stations(snap, "num_docks_available", threshold))
+    index = graph_cache.station_index(snap)
+    return (index.available(session["bikes"], "num_bikes_available", threshold),
+            index.available(session["bikes"], "num_docks_available", threshold))
+
+
+# Sends an image of the shortest route between two given addresses, starting at a station with
+# bikes and ending at one with docks, more than the threshold if given, with a summary of it.
+# e.g. /route Sagrada Familia, Plaça Catalunya, 2
+@serialized
 def route(bot, update, args):
     try:
         usr_id = update.message.from_user["id"]
@@ -126,13 +365,69 @@ def route(bot, update, args):
         address = ""
         for word in args:
             address = address + " " + word
-        dt.shortest_path(dict_graphs[usr_id][0], address)
-        bot.send_photo(chat_id=update.message.chat_id, photo=open("path.png", "rb"))
+        parts = address.split(",")
+        threshold = 0
+        if len(parts) == 3:
+            if not re.match('^[0-9]+$', parts[2].strip()):
+                raise ValueError("The threshold must be a positive integer or 0")
+            threshold = int(parts[2])
+            address = ",".join(parts[:2])
+
+        session = dict_graphs[usr_id]
+        G = graph_cache.route_graph(session["snapshot"], session["dist"], lazy=True)
+        origins, destinations = route_stations(session, threshold)
+        path, start, finish = dt.find_route(G, address, origins, destinations)
+        key = render.content_key("path", [(G.node[st]["lat"], G.node[st]["lon"]) for st in path], start, finish, IMAGE_SIZE)
+        image = image_cache.get(key)
+        if image is None:
+            image = run_heavy(dt.draw_path, G, path, start, finish, IMAGE_SIZE)
+            image_cache.put(key, image)
+        bikes = session["bikes"] if session["bikes"] is not None else session["snapshot"].bikes
+        caption = dt.text_route(G, path, start, finish, bikes)
+        bot.send_photo(chat_id=update.message.chat_id, photo=image, caption=caption)
+    except Exception as e:
+        send_error(bot, "Error: " + e.args[0], update.message.chat_id)
+
+
+# Prints the stations nearest to the given address, only the ones with bikes or docks if asked.
+# The options go after a comma, so that the numbers of the address are not taken for them,
+# e.g. /nearest Diagonal 640, bikes 5
+@serialized
+def nearest(bot, update, args):
+    try:
+        address, _, options = " ".join(args).partition(",")
+        k = 3
+        kind = None
+        for option in options.split():
+            if re.match('^[0-9]+$', option):
+                k = int(option)
+            elif option.lower() in dt.NEAREST_COLUMNS:
+                kind = option.lower()
+            else:
+                raise ValueError("The options must be bikes or docks and the number of stations")
+        if not address.strip():
+            raise ValueError("Too few arguments")
+        if not 0 < k <= MAX_NEAREST:
+            raise ValueError("The number of stations must be between 1 and " + str(MAX_NEAREST))
+
+        try:
+            with metrics.timed("bicing_stage_seconds", stage="geocoding"):
+                coords = dt.get_geocoder().locate(address)
+        except Exception:
+            raise ValueError("Address not found")
+        snap = latest_snapshot()
+        index = graph_cache.station_index(snap)
+        subset = None
+        if kind is not None:
+            subset = graph_cache.available_stations(snap, dt.NEAREST_COLUMNS[kind])
+        table = dt.nearest_stations(index, snap.bikes, coords, kind, k, subset=subset)
+        send_to_user(bot, dt.text_nearest(table, snap.stations), update.message.chat_id)
     except Exception as e:
         send_error(bot, "Error: " + e.args[0], update.message.chat_id)
 
 
 # Updates the graph with a new given distance.
+@serialized
 def graph(bot, update, args):
     try:
         usr_id = update.message.from_user["id"]
@@ -143,26 +438,50 @@ def graph(bot, update, args):
         if str(args[0]) != "0" and not re.match(r"\d+\.*\d*", str(args[0])):
             raise ValueError("Distance must be a positive number")
 
-        global dict_graphs
-        dict_graphs[usr_id] = [dt.build_graph(args[0], dict_graphs[usr_id][0]), float(args[0]), dict_graphs[usr_id][2]]
+        session = dict_graphs[usr_id]
+        set_graph(usr_id, args[0], session["snapshot"], session["bikes"])
         send_to_user(bot, "Graph updated to distance " + args[0], update.message.chat_id)
     except Exception as e:
         send_error(bot, "Error: " + e.args[0], update.message.chat_id)
 
 
 # Displays information of the cost of distributing the bycicles.
+@serialized
 def distribute(bot, update, args):
     try:
         usr_id = update.message.from_user["id"]
         check_id(usr_id)
-        check_args(args, 2)
+        check_args(args, 2, False)
+        if len(args) > 3:
+            raise ValueError("Too many arguments")
 
         # Check they are non-negative integers
-        if (not re.match('^[0-9]+$', str(args[0])) or not re.match('^[0-9]+$', str(args[1])) or
-                int(args[0]) < 0 or int(args[1]) < 0):
-            raise ValueError("Demands must be positive integers or 0")
-
-        info = dt.minflow((int(args[0]), int(args[1])), dict_graphs[usr_id][1], dict_graphs[usr_id][2])
+        if not all(re.match('^[0-9]+$', str(arg)) for arg in args):
+            raise ValueError("Demands and minutes must be positive integers or 0")
+
+        # The bikes are shared with the other users until this user modifies them
+        session = dict_graphs[usr_id]
+        bikes = session["bikes"]
+        if bikes is None:
+            bikes = session["snapshot"].bikes.copy()
+
+        demand = (int(args[0]), int(args[1]))
+        sts_bikes = (session["snapshot"].stations, bikes)
+        if len(args) == 3:
+            # The distribution of the bikes forecast some minutes ahead, which are not modified
+            minutes = int(args[2])
+            if status_history is None:
+                raise ValueError("There is no history to forecast the bikes")
+            if minutes > MAX_FORECAST:
+                raise ValueError("The bikes can only be forecast up to %d minutes ahead" % MAX_FORECAST)
+            baseline.update(status_history)
+            now = session["snapshot"].last_updated or time.time()
+            sts_bikes = (session["snapshot"].stations, baseline.predict(bikes, now, minutes))
+            info = run_heavy(dt.minflow, demand, session["dist"], sts_bikes)
+            info = "Forecast for %d minutes ahead\n" % minutes + info
+        else:
+            info, session["bikes"] = run_heavy(dt.distribute_bikes, demand, session["dist"], sts_bikes)
+            save_session(usr_id)
         send_to_user(bot, info, update.message.chat_id, True)
     except Exception as e:
         if e.args[0] == "impossible":
@@ -171,6 +490,40 @@ def distribute(bot, update, args):
             send_error(bot, "Error: " + e.args[0], update.message.chat_id)
 
 
+# Displays the cost of distributing the bycicles for every given demand and distance, e.g.
+# /distributesweep 1,1 2,2 5,5 500 1000 2000 chart
+@serialized
+def distributesweep(bot, update, args):
+    try:
+        usr_id = update.message.from_user["id"]
+        check_id(usr_id)
+
+        chart = "chart" in args
+        args = [arg for arg in args if arg != "chart"]
+        demands = [tuple(int(x) for x in arg.split(",")) for arg in args if re.match('^[0-9]+,[0-9]+$', arg)]
+        dists = [float(arg) for arg in args if re.match(r'^\d+\.?\d*$', arg)]
+        if len(demands) + len(dists) != len(args):
+            raise ValueError("Demands must be pairs of integers like 2,3 and distances positive numbers")
+        if not demands:
+            raise ValueError("Too few arguments")
+        if not dists:
+            dists = [dict_graphs[usr_id]["dist"]]
+        if len(demands) * len(dists) > MAX_SWEEP:
+            raise ValueError("At most " + str(MAX_SWEEP) + " demands times distances")
+
+        # The bikes are only read, so the ones of the user (or the shared ones) can be used directly
+        session = dict_graphs[usr_id]
+        bikes = session["bikes"] if session["bikes"] is not None else session["snapshot"].bikes
+        pairs = graph_cache.pair_table(session["snapshot"])
+        table = dt.distribute_sweep(demands, dists, (session["snapshot"].stations, bikes), pairs, heavy_executor)
+
+        send_to_user(bot, "```\n" + dt.text_sweep(table) + "\n```", update.message.chat_id, True)
+        if chart:
+            bot.send_photo(chat_id=update.message.chat_id, photo=run_heavy(render.draw_sweep, table))
+    except Exception as e:
+        send_error(bot, "Error: " + e.args[0], update.message.chat_id)
+
+
 # Displays the names of the authors of this project
 def authors(bot, update):
     try:
@@ -180,37 +533,105 @@ def authors(bot, update):
         send_error(bot, "Error: " + e.args[0], update.message.chat_id)
 
 
+# Displays a summary of the metrics to the administrators.
+@serialized
+def stats(bot, update):
+    try:
+        if update.message.from_user["id"] not in ADMINS:
+            raise ValueError("Only the administrators can see the statistics")
+        text = metrics.summary()
+        users = len(dict_graphs)
+        if users:
+            text += "\nbytes of the graphs per user: %d" % (graph_cache.size / users)
+        send_to_user(bot, text, update.message.chat_id)
+    except Exception as e:
+        send_error(bot, "Error: " + e.args[0], update.message.chat_id)
+
+
 # Updates the graph with the same distance but new information
+@serialized
 def update(bot, update):
     try:
         usr_id = update.message.from_user["id"]
+        check_id(usr_id)
 
-        global dict_graphs
-        dict_graphs[usr_id] = [dt.build_graph(dict_graphs[usr_id][1], None), dict_graphs[usr_id][1], dt.get_dataframe(True)]
+        set_graph(usr_id, dict_graphs[usr_id]["dist"], latest_snapshot())
         send_to_user(bot, "Graph updated", update.message.chat_id)
     except Exception as e:
         send_error(bot, "Error: " + e.args[0], update.message.chat_id)
 
 
-# The access token located in "token.txt"
-TOKEN = open('token.txt').read().strip()
+# Adds the handlers of all the commands to the given dispatcher.
+def add_handlers(dispatcher):
+    dispatcher.add_handler(CommandHandler('start', start))
+    dispatcher.add_handler(CommandHandler('help', help))
+    dispatcher.add_handler(CommandHandler('edges', edges))
+    dispatcher.add_handler(CommandHandler('nodes', nodes))
+    dispatcher.add_handler(CommandHandler('components', components))
+    dispatcher.add_handler(CommandHandler('plotgraph', plotgraph))
+    dispatcher.add_handler(CommandHandler('graph', graph, pass_args=True))
+    dispatcher.add_handler(CommandHandler('route', route, pass_args=True))
+    dispatcher.add_handler(CommandHandler('nearest', nearest, pass_args=True))
+    dispatcher.add_handler(CommandHandler('distribute', distribute, pass_args=True))
+    dispatcher.add_handler(CommandHandler('distributesweep', distributesweep, pass_args=True))
+    dispatcher.add_handler(CommandHandler('update', update))
+    dispatcher.add_handler(CommandHandler('authors', authors))
+    dispatcher.add_handler(CommandHandler('stats', stats))
+
+
+# Returns the options of the bot, given on the command line or else by the environment variables
+# of the same name (e.g. --state-dir or BICING_STATE_DIR).
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="The Bicing bot of Telegram.")
+    parser.add_argument("--token", default=os.environ.get("BICING_TOKEN"),
+                        help="the access token of the bot, read from --token-file if not given")
+    parser.add_argument("--token-file", default=os.environ.get("BICING_TOKEN_FILE", "token.txt"))
+    parser.add_argument("--state-dir", default=os.environ.get("BICING_STATE_DIR", "state"),
+                        help="where the sessions of the users are kept")
+    parser.add_argument("--workers", type=int, default=os.environ.get("BICING_WORKERS", WORKERS),
+                        help="threads answering the commands")
+    parser.add_argument("--metrics-file", default=os.environ.get("BICING_METRICS_FILE"),
+                        help="file where the metrics are written every 15 seconds")
+    parser.add_argument("--metrics-port", type=int, default=os.environ.get("BICING_METRICS_PORT"),
+                        help="port where the metrics are served, at /metrics")
+    parser.add_argument("--feed-url", default=os.environ.get("BICING_FEED_URL", feed.URL),
+                        help="where the GBFS feeds are downloaded from")
+    parser.add_argument("--history-dir", default=os.environ.get("BICING_HISTORY_DIR", "history"),
+                        help="where the history of the status of the stations is kept")
+    parser.add_argument("--history-days", type=int, default=os.environ.get("BICING_HISTORY_DAYS", 30),
+                        help="days of history kept, none with 0")
+    args = parser.parse_args(argv)
+
+    if args.token is None:
+        try:
+            with open(args.token_file) as f:
+                args.token = f.read().strip()
+        except OSError:
+            parser.error("no access token: give --token or BICING_TOKEN, or write it in " + args.token_file)
+    return args
 
-# Objects necessary to work with Telegram.
-updater = Updater(token=TOKEN)
-dispatcher = updater.dispatcher
-
-# The possible commands to wait for.
-dispatcher.add_handler(CommandHandler('start', start))
-dispatcher.add_handler(CommandHandler('help', help))
-dispatcher.add_handler(CommandHandler('edges', edges))
-dispatcher.add_handler(CommandHandler('nodes', nodes))
-dispatcher.add_handler(CommandHandler('components', components))
-dispatcher.add_handler(CommandHandler('plotgraph', plotgraph))
-dispatcher.add_handler(CommandHandler('graph', graph, pass_args=True))
-dispatcher.add_handler(CommandHandler('route', route, pass_args=True))
-dispatcher.add_handler(CommandHandler('distribute', distribute, pass_args=True))
-dispatcher.add_handler(CommandHandler('update', update))
-dispatcher.add_handler(CommandHandler('authors', authors))
 
 # Starts the bot.
-updater.start_polling()
+def main(argv=None):
+    global poller
+    args = parse_args(argv)
+    poller = feed.FeedPoller(args.feed_url)
+
+    # Objects necessary to work with Telegram.
+    updater = Updater(token=args.token, workers=args.workers)
+    add_handlers(updater.dispatcher)
+
+    restore(args.state_dir)
+    if args.history_days > 0:
+        keep_history(args.history_dir, args.history_days)
+    if args.metrics_file:
+        metrics.write_every(args.metrics_file)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+
+    poller.start()
+    updater.start_polling()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+import numpy as np
+import networkx as nx
+import data as dt
+import files
+import metrics
+
+
+# Approximate memory (in bytes) taken by every node and edge of a networkx graph
+NODE_BYTES = 600
+EDGE_BYTES = 400
+
+# Number of data.LazyGraphs kept, along with the edges their routes have built
+LAZY_GRAPHS = 64
+
+# Number of subsets of available stations (see GraphCache.available_stations) kept
+AVAILABLE_SETS = 32
+
+# The arrays of the stored graphs and tables that go to their own .npy files, to be memory-mapped
+# when read: the routing tables of the networkx graphs, and all but the ids of the stations of
+# the data.StationGraphs and the tables of pairs. The rest go together to a .npz file.
+MAPPED_ROUTING = ("dist", "pred")
+MAPPED_GRAPH = ("lat", "lon", "data", "indices", "indptr")
+MAPPED_TABLE = ("lat", "lon", "i", "j", "l", "reach", "merges")
+
+
+# Returns an estimation of the memory used by the graph G, in bytes.
+def graph_bytes(G):
+    if isinstance(G, dt.StationGraph):
+        return G.nbytes()
+    size = G.number_of_nodes() * NODE_BYTES + G.number_of_edges() * EDGE_BYTES
+    if "routing" in G.graph:
+        size += G.graph["routing"]["dist"].nbytes + G.graph["routing"]["pred"].nbytes
+    return size
+
+
+# Graphs shared by all the users, indexed by (version of the stations, distance).
+# The graphs are frozen, so they can not be modified once they are in the cache. With
+# station_graphs=True they are data.StationGraphs instead, built from the tables of pairs.
+# Graphs used by some user are only evicted when the memory cap is exceeded and
+# no unused graph is left; the least recently used ones go first.
+# For every version of the stations a data.PairTable is kept as well, from which the
+# graphs are built and the connected components are counted.
+# With a "store" directory, every graph and table is also written there once built, and read
+# from there instead of being built again, e.g. after restarting the bot. The arrays of the
+# tables and of the StationGraphs are written to .npy files and memory-mapped (read-only) from
+# there, even by the process that built them, so all the processes sharing the store (see
+# cluster.py) share a single copy of them in memory.
+class GraphCache:
+
+    # With routing=True the graphs are built with their routing tables (see data.build_graph).
+    # The graphs are built by calling "builder" with the same arguments as data.build_graph,
+    # which allows building them somewhere else, e.g. in another process.
+    def __init__(self, max_bytes=512 * 1024 * 1024, routing=True, builder=dt.build_graph, store=None,
+                 station_graphs=False):
+        self.max_bytes = max_bytes
+        self.routing = routing
+        self.builder = builder
+        self.station_graphs = station_graphs
+        self.store = store
+        self.graphs = OrderedDict()  # key -> graph, from least to most recently used
+        self.tables = dict()  # version of the stations -> their table of pairs
+        self.indexes = dict()  # version of the stations -> their spatial index
+        self.lazy = OrderedDict()  # key -> lazy graph, from least to most recently used
+        self.available = OrderedDict()  # (versions, column, threshold) -> subset of the stations
+        self.refs = dict()  # key -> number of users holding it
+        self.size = 0  # estimated memory of all the cached graphs
+        self.lock = threading.Lock()
+
+    # Returns the graph for the given snapshot and distance, building it if needed. With
+    # build=False it returns None instead if it is neither cached nor in the store.
+    def get(self, snapshot, dist, build=True):
+        key = (snapshot.stations_version, float(dist))
+        with self.lock:
+            if key in self.graphs:
+                self.graphs.move_to_end(key)
+                metrics.count("bicing_cache_requests_total", cache="graph", result="hit")
+                return self.graphs[key]
+
+        # Built outside the lock so that lookups of other graphs are not blocked
+        if build:
+            metrics.count("bicing_cache_requests_total", cache="graph", result="miss")
+        G = self.read_graph(key)
+        if G is not None:
+            metrics.count("bicing_cache_requests_total", cache="graph", result="disk")
+        elif not build:
+            return None
+        if G is None and self.station_graphs:
+            G = dt.build_station_graph(float(dist), snapshot.stations, self.pair_table(snapshot))
+            self.write_graph(key, G)
+            G = self.read_graph(key) or G  # memory-mapped, unless there is no store
+        elif G is None:
+            pairs = self.pair_table(snapshot)
+            G = nx.freeze(self.builder(float(dist), stations=snapshot.stations, routing=self.routing, pairs=pairs))
+            self.write_graph(key, G)
+
+        with self.lock:
+            if key in self.graphs:  # somebody else built it in the meantime
+                return self.graphs[key]
+            self.graphs[key] = G
+            self.size += graph_bytes(G)
+            metrics.observe("bicing_graph_bytes", graph_bytes(G), metrics.BYTES)
+            self.evict()
+            self.report()
+            return G
+
+    # Returns the table of pairs of the stations of the given snapshot, building it if needed.
+    def pair_table(self, snapshot):
+        version = snapshot.stations_version
+        with self.lock:
+            if version in self.tables:
+                return self.tables[version]
+
+        pairs = self.read_table(version)
+        if pairs is None:
+            with metrics.timed("bicing_stage_seconds", stage="pair_table"):
+                pairs = dt.PairTable(snapshot.stations)
+            self.write_table(version, pairs)
+            pairs = self.read_table(version) or pairs  # memory-mapped, unless there is no store
+
+        with self.lock:
+            if version not in self.tables:
+                self.tables[version] = pairs
+                self.size += pairs.nbytes()
+                self.report()
+            return self.tables[version]
+
+    # Returns the spatial index of the stations of the given snapshot, building it if needed.
+    def station_index(self, snapshot):
+        version = snapshot.stations_version
+        with self.lock:
+            if version in self.indexes:
+                return self.indexes[version]
+
+        index = dt.StationIndex(snapshot.stations)
+
+        with self.lock:
+            if version not in self.indexes:
+                self.indexes[version] = index
+                self.size += index.nbytes()
+            return self.indexes[version]
+
+    # Returns the data.StationSubset of the stations of the given snapshot with more than
+    # "threshold" of the given column of its status (e.g. "num_bikes_available"), building it
+    # if needed. They are kept for the latest snapshots, so every query reuses them.
+    def available_stations(self, snapshot, column, threshold=0):
+        key = (snapshot.stations_version, snapshot.version, column, threshold)
+        with self.lock:
+            if key in self.available:
+                self.available.move_to_end(key)
+                return self.available[key]
+
+        subset = self.station_index(snapshot).available(snapshot.bikes, column, threshold)
+
+        with self.lock:
+            subset = self.available.setdefault(key, subset)
+            while len(self.available) > AVAILABLE_SETS:
+                self.available.popitem(last=False)
+            return subset
+
+    # Returns the graph for the given snapshot and distance to look for routes on: the graph
+    # itself if it is already built, or a data.LazyGraph that does not need building. With
+    # lazy=True it is always the data.LazyGraph, which routes between some stations only.
+    # With station_graphs=True the data.LazyGraph takes the edges from the StationGraph if it
+    # is cached or in the store.
+    def route_graph(self, snapshot, dist, lazy=False):
+        key = (snapshot.stations_version, float(dist))
+        with self.lock:
+            if key in self.graphs and not lazy:
+                self.graphs.move_to_end(key)
+                return self.graphs[key]
+            if key in self.lazy:
+                self.lazy.move_to_end(key)
+                return self.lazy[key]
+
+        graph = self.get(snapshot, dist, build=False) if self.station_graphs else None
+        G = dt.LazyGraph(self.station_index(snapshot), dist, graph)
+
+        with self.lock:
+            G = self.lazy.setdefault(key, G)
+            while len(self.lazy) > LAZY_GRAPHS:
+                self.lazy.popitem(last=False)
+            return G
+
+    # Returns the number of edges of the graph for the given snapshot and distance.
+    def edges(self, snapshot, dist):
+        pairs = self.pair_table(snapshot)
+        if float(dist) <= 0:
+            return 0
+        if float(dist) <= pairs.max_dist:
+            return len(pairs.edges(float(dist)))
+        return dt.number_edges(self.get(snapshot, dist))
+
+    # Returns the number of connected components of the graph for the given snapshot and distance.
+    def components(self, snapshot, dist):
+        pairs = self.pair_table(snapshot)
+        if float(dist) <= pairs.max_dist:
+            return pairs.components(float(dist))
+        return dt.number_components(self.get(snapshot, dist))
+
+    # Registers a new user of the given graph, without building it until it is needed.
+    def register(self, snapshot, dist):
+        key = (snapshot.stations_version, float(dist))
+        with self.lock:
+            self.refs[key] = self.refs.get(key, 0) + 1
+            self.evict_unused()
+
+    # Unregisters a user of the given graph.
+    def release(self, snapshot, dist):
+        key = (snapshot.stations_version, float(dist))
+        with self.lock:
+            if self.refs.get(key, 0) <= 1:
+                self.refs.pop(key, None)
+            else:
+                self.refs[key] -= 1
+            self.evict_unused()
+
+    # Removes graphs until the memory cap is respected, unused ones first.
+    # Must be called with the lock held.
+    def evict(self):
+        for in_use in [False, True]:
+            for key in list(self.graphs):
+                if self.size <= self.max_bytes or len(self.graphs) == 1:
+                    return
+                if (key in self.refs) == in_use:
+                    self.size -= graph_bytes(self.graphs.pop(key))
+                    self.evict_table(key[0])
+
+    # Removes the table, the index, the lazy graphs and the subsets of available stations of the
+    # given version of the stations if none of its graphs is cached nor used by anybody.
+    # Must be called with the lock held.
+    def evict_table(self, version):
+        if any(v == version for v, d in self.graphs) or any(v == version for v, d in self.refs):
+            return
+        if version in self.tables:
+            self.size -= self.tables.pop(version).nbytes()
+        if version in self.indexes:
+            self.size -= self.indexes.pop(version).nbytes()
+        for cached in [self.lazy, self.available]:
+            for key in [key for key in cached if key[0] == version]:
+                del cached[key]
+
+    # Removes what was kept of the versions of the stations nobody uses any more (see evict_table),
+    # e.g. those of the snapshots the users left with /update, whose graphs were never built.
+    # Must be called with the lock held.
+    def evict_unused(self):
+        keys = list(self.lazy) + list(self.available)
+        for version in set(self.tables) | set(self.indexes) | set(key[0] for key in keys):
+            self.evict_table(version)
+        self.report()
+
+    # Updates the metrics of the size of the cache. Must be called with the lock held.
+    def report(self):
+        metrics.set_gauge("bicing_cache_bytes", self.size, cache="graph")
+        metrics.set_gauge("bicing_cached_graphs", len(self.graphs))
+        metrics.set_gauge("bicing_graphs_in_use", len(self.refs))
+
+    # Returns the path of the file of the store with the given name.
+    def path(self, name):
+        return os.path.join(self.store, name)
+
+    # Writes the arrays to the store with the given name: the ones in "mapped" to their own .npy
+    # files, and the rest to a .npz file, the last one, so that they are complete once it exists.
+    def write_arrays(self, name, arrays, mapped=()):
+        if self.store is None:
+            return
+        os.makedirs(self.store, exist_ok=True)
+        for array in mapped:
+            if array in arrays:
+                with files.replacing(self.path("%s.%s.npy" % (name, array)), ".npy") as tmp:
+                    np.save(tmp, arrays[array])
+        with files.replacing(self.path(name + ".npz"), ".npz") as tmp:
+            np.savez(tmp, **{array: values for array, values in arrays.items() if array not in mapped})
+
+    # Returns the arrays of the store with the given name, or None if they are not there. The
+    # ones in "mapped" are memory-mapped from their .npy files, read-only.
+    def read_arrays(self, name, mapped=()):
+        if self.store is None or not os.path.isfile(self.path(name + ".npz")):
+            return None
+        with np.load(self.path(name + ".npz")) as f:
+            arrays = dict(f)
+        for array in mapped:
+            if os.path.isfile(self.path("%s.%s.npy" % (name, array))):
+                arrays[array] = np.load(self.path("%s.%s.npy" % (name, array)), mmap_mode="r")
+        return arrays
+
+    # Writes the graph with the given key to the store.
+    def write_graph(self, key, G):
+        if isinstance(G, dt.StationGraph):
+            self.write_arrays("csr_%d_%r" % key, G.arrays(), MAPPED_GRAPH)
+        else:
+            self.write_arrays("graph_%d_%r" % key, dt.graph_arrays(G), MAPPED_ROUTING)
+
+    # Returns the graph with the given key from the store, or None if it is not there.
+    def read_graph(self, key):
+        if self.station_graphs:
+            arrays = self.read_arrays("csr_%d_%r" % key, MAPPED_GRAPH)
+        else:
+            arrays = self.read_arrays("graph_%d_%r" % key, MAPPED_ROUTING)
+        if arrays is None:
+            return None
+        if self.station_graphs:
+            return dt.StationGraph.from_arrays(arrays)
+        return nx.freeze(dt.graph_from_arrays(arrays))
+
+    def write_table(self, version, pairs):
+        self.write_arrays("pairs_%d" % version, pairs.arrays(), MAPPED_TABLE)
+
+    # Returns the table of pairs of the given version of the stations from the store, or None.
+    def read_table(self, version):
+        arrays = self.read_arrays("pairs_%d" % version, MAPPED_TABLE)
+        return None if arrays is None else dt.PairTable.from_arrays(arrays)
+
+    # Deletes from the store the graphs and tables of the versions of the stations not given.
+    def prune_store(self, versions):
+        if self.store is None or not os.path.isdir(self.store):
+            return
+        for name in os.listdir(self.store):
+            match = re.match(r"(graph|csr|pairs)_(\d+)", name)
+            if match and int(match.group(2)) not in versions:
+                os.remove(self.path(name))
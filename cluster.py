@@ -0,0 +1,220 @@
+# Runs the bot as several processes, so that it uses more than one core: a front process receives
+# the updates of Telegram through a webhook and hands every one to the worker process of its user
+# (the one with number usr_id % N), so the session of a user always stays in the same process.
+# The workers share the state directory of the bot: the sessions, the graphs and tables of pairs
+# of the cache (stored as arrays in .npy files, which every worker memory-maps read-only, so a
+# graph built by one worker is used by all of them from a single copy in memory) and the
+# snapshots of the data, which only the first worker downloads and publishes in "snapshots/".
+# Usage: python cluster.py --processes 4 --port 8443 --webhook-url https://host/path [options of bot.py]
+import os
+import sys
+import json
+import queue
+import argparse
+import threading
+import multiprocessing
+from urllib.parse import urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# Number of snapshots kept in "snapshots/" besides the latest one, for the workers still reading them.
+KEEP_SNAPSHOTS = 2
+
+
+# Returns the number of the worker that attends the given user.
+def partition(usr_id, n_workers):
+    return usr_id % n_workers
+
+
+# Returns the id of the user who sent the given update (parsed from json), or 0 if it has none.
+def update_user(data):
+    for kind in ("message", "edited_message", "callback_query", "inline_query"):
+        if isinstance(data.get(kind), dict) and "from" in data[kind]:
+            return data[kind]["from"]["id"]
+    return 0
+
+
+# Receives the updates sent by Telegram to the path of the webhook and puts them, still in json,
+# in the queue of the worker of their user. It answers at once, without waiting for the workers.
+class WebhookHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        if self.path != self.server.path:
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            usr_id = update_user(json.loads(body))
+        except ValueError:
+            self.send_error(400)
+            return
+
+        queues = self.server.queues
+        queues[partition(usr_id, len(queues))].put(("update", body))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+# The front process: a server of the webhook that hands the updates to the workers' queues.
+# Telegram opens up to 40 connections at once to a webhook, more than the 5 waiting to be
+# accepted by default.
+class WebhookServer(ThreadingHTTPServer):
+    request_queue_size = 64
+
+    def __init__(self, queues, path="/", host="0.0.0.0", port=8443):
+        super().__init__((host, port), WebhookHandler)
+        self.queues = queues
+        self.path = path
+        self.url = "http://127.0.0.1:%d%s" % (self.server_address[1], path)
+
+
+# The snapshots of a worker other than the first, the ones published by it. Used instead of the
+# poller of the feeds (see bot.latest_snapshot).
+class SharedSnapshots:
+
+    def __init__(self, directory, timeout=60):
+        self.directory = directory
+        self.timeout = timeout
+        self.snapshot = None
+        self.ready = threading.Event()
+
+    # Reads the snapshot with the given versions, published by the first worker.
+    def load(self, version, stations_version):
+        import sessions
+        self.snapshot = sessions.read_snapshot(self.directory, version, stations_version, self.snapshot)
+        self.ready.set()
+
+    # Returns the latest snapshot, waiting for the first one to be published if there is none yet.
+    def get_snapshot(self):
+        if self.snapshot is None and not self.ready.wait(self.timeout):
+            raise ValueError("Could not download the data")
+        return self.snapshot
+
+
+# Returns a function that publishes every new snapshot in the given directory and tells the
+# workers of the given queues, deleting the old ones.
+def publisher(directory, queues):
+    import sessions
+    os.makedirs(directory, exist_ok=True)
+    published = []
+
+    def publish(snap):
+        sessions.write_snapshot(directory, snap)
+        published.append(snap)
+        del published[:-KEEP_SNAPSHOTS - 1]
+        sessions.prune_snapshots(directory, set(s.version for s in published),
+                                 set(s.stations_version for s in published))
+        for q in queues:
+            q.put(("snapshot", snap.version, snap.stations_version))
+    return publish
+
+
+# Runs the worker with the given number until it gets None: the commands of the updates of its
+# queue are attended by the handlers of bot.py, with the options of bot.py given in argv. The
+# messages are sent by the bot returned by make_bot() if given (e.g. a fake one), or else by a
+# telegram.Bot, and the first worker registers the webhook with the given url, if any.
+def run_worker(number, queues, argv, make_bot=None, webhook_url=None):
+    # Imported here so that the front process does not need them
+    import telegram
+    from telegram.ext import Dispatcher
+    import bot
+    import feed
+    import metrics
+
+    args = bot.parse_args(argv)
+    if args.metrics_file:
+        metrics.write_every("%s.%d" % (args.metrics_file, number))
+    if args.metrics_port:
+        metrics.serve(args.metrics_port + number)
+
+    directory = os.path.join(args.state_dir, "snapshots")
+    if number == 0:
+        bot.poller = feed.FeedPoller(args.feed_url)
+    else:
+        bot.poller = SharedSnapshots(directory)
+    bot.restore(args.state_dir, lambda usr_id: partition(usr_id, len(queues)) == number, prune=number == 0)
+    if args.history_days > 0:
+        bot.keep_history(args.history_dir, args.history_days, record=number == 0)
+
+    messenger = telegram.Bot(args.token) if make_bot is None else make_bot()
+    dispatcher = Dispatcher(messenger, queue.Queue(), workers=args.workers)
+    bot.add_handlers(dispatcher)
+    ready = threading.Event()
+    threading.Thread(target=dispatcher.start, args=(ready,), daemon=True).start()
+    ready.wait()
+
+    if number == 0:
+        bot.poller.listeners.append(publisher(directory, queues[1:]))
+        bot.poller.start()
+        if webhook_url is not None:
+            messenger.set_webhook(url=webhook_url)
+
+    while True:
+        message = queues[number].get()
+        if message is None:
+            break
+        if message[0] == "update":
+            dispatcher.update_queue.put(telegram.Update.de_json(json.loads(message[1]), messenger))
+        elif message[0] == "snapshot":
+            try:
+                bot.poller.load(message[1], message[2])
+            except OSError:
+                pass  # already deleted by the first worker, so a newer one is on its way
+
+    dispatcher.stop()
+    if number == 0:
+        bot.poller.stop()
+    if bot.heavy_pool is not None:
+        bot.heavy_pool.shutdown()
+
+
+# Starts n worker processes (see run_worker). Returns their queues and processes.
+def start_workers(n, argv, make_bot=None, webhook_url=None):
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue() for _ in range(n)]
+    processes = [context.Process(target=run_worker, args=(number, queues, argv, make_bot, webhook_url))
+                 for number in range(n)]
+    for process in processes:
+        process.start()
+    return queues, processes
+
+
+def stop_workers(queues, processes):
+    for q in queues:
+        q.put(None)
+    for process in processes:
+        process.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="The Bicing bot of Telegram, as several processes.",
+                                     epilog="The other options are the ones of bot.py, given to every worker.")
+    parser.add_argument("--processes", type=int, default=os.environ.get("BICING_PROCESSES", os.cpu_count()),
+                        help="number of worker processes")
+    parser.add_argument("--host", default=os.environ.get("BICING_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=os.environ.get("BICING_PORT", 8443),
+                        help="port where the updates are received")
+    parser.add_argument("--webhook-url", default=os.environ.get("BICING_WEBHOOK_URL"),
+                        help="public url of the webhook, registered with Telegram; its path is the one served")
+    args, bot_argv = parser.parse_known_args(argv)
+
+    path = "/"
+    if args.webhook_url:
+        path = urlparse(args.webhook_url).path or "/"
+    queues, processes = start_workers(args.processes, bot_argv, webhook_url=args.webhook_url)
+    server = WebhookServer(queues, path, args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    stop_workers(queues, processes)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,42 @@
-# Importing the necessary libraries.
+# Importing the necessary libraries. The ones only some commands need (staticmap to draw, geopy
+# to geocode, scipy.optimize to solve flows and scipy.spatial to find the pairs of stations) are
+# imported by the functions that use them, so that starting the bot and its workers is fast.
 import pandas as pd
 import networkx as nx
-from staticmap import StaticMap, CircleMarker, Line
 from haversine import haversine
-import geopy as geo
+import geocoding
+import render
+import history
+import metrics
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse import vstack, hstack, triu
+from scipy.sparse.csgraph import shortest_path as all_pairs_shortest_path
+from scipy.sparse.csgraph import connected_components, dijkstra
 from math import ceil
+from itertools import count
+import heapq
+from collections import namedtuple
 import copy
 
 
+EARTH_RADIUS = 6371.0088  # mean radius of the Earth in km, the same one used by haversine
+KM_LAT = 111  # km per degree of latitude
+KM_LON = 83  # km per degree of longitude around Barcelona
+MAX_DIST = 5000  # the distance (in meters) up to which the pairs of stations are precomputed
+FLOW_SOLVER = "highs"  # the solver used by minflow, see solve_flow
+
+# The geocoder used by get_coords. Another one (e.g. with a geocoding.StubGeocoder client)
+# may be assigned to work offline.
+geocoder = None
+
+# A version of the downloaded data: the stations and the bikes they have. The version of the
+# stations only changes when they do, so graphs can be reused while only the bikes change.
+# The time (unix) when the bikes were last updated is the one of their feed, if known.
+Snapshot = namedtuple('Snapshot', ['version', 'stations_version', 'stations', 'bikes', 'last_updated'],
+                      defaults=(None,))
+
+
 def authors():
     message = '''
     This project was made by
@@ -29,35 +58,125 @@ def number_edges(G):
 
 # Returns the number of connected components of a given graph.
 def number_components(G):
+    if isinstance(G, StationGraph):
+        return connected_components(G.adjacency, directed=False, return_labels=False)
     return nx.number_connected_components(G)
 
 
-# Returns the shortest path from "start" to "finish".
-def compute_path(G, start, finish):
-    # Connect the new edges to all others at walking speed
-    for station in G.nodes():
-        l1 = haversine(start, (G.node[station]['lat'], G.node[station]['lon']))
-        l2 = haversine(finish, (G.node[station]['lat'], G.node[station]['lon']))
-        G.add_edge("S", station, weight=l1/4)
-        G.add_edge("F", station, weight=l2/4)
+# Precomputes the distance and the predecessor matrices between all pairs of stations of G,
+# stored in G.graph["routing"] so that routes become a lookup in the tables.
+def add_routing_index(G):
+    nodes, lat, lon = station_arrays(G)
+    position = {node: k for k, node in enumerate(nodes)}
+
+    edges = list(G.edges(data="weight"))
+    i = [position[u] for u, v, w in edges]
+    j = [position[v] for u, v, w in edges]
+    w = [w for u, v, w in edges]
+    matrix = csr_matrix((w, (i, j)), shape=(len(nodes), len(nodes)))  # explicit zeros are kept as edges
+
+    dist, pred = all_pairs_shortest_path(matrix, method="D", directed=False, return_predecessors=True)
+    G.graph["routing"] = {"nodes": nodes, "lat": lat, "lon": lon, "dist": dist, "pred": pred}
+
+
+# Returns the shortest path from "start" to "finish" using the precomputed tables of G:
+# the minimum of walking to a station, riding to another one and walking from it.
+def indexed_path(G, start, finish):
+    index = G.graph["routing"]
+    nodes, lat, lon = index["nodes"], index["lat"], index["lon"]
+    if not nodes:
+        raise ValueError("The graph has no stations")
+    walk_start = haversine_array(start[0], start[1], lat, lon) / 4
+    walk_finish = haversine_array(finish[0], finish[1], lat, lon) / 4
+
+    # Walking through a single station bounds the cost, so farther stations are discarded
+    bound = np.min(walk_start + walk_finish)
+    first = np.flatnonzero(walk_start <= bound)
+    last = np.flatnonzero(walk_finish <= bound)
+
+    total = walk_start[first, None] + index["dist"][np.ix_(first, last)] + walk_finish[None, last]
+    a, b = np.unravel_index(np.argmin(total), total.shape)
+    a, b = first[a], last[b]
+
+    # Rebuild the path from the last station
+    path = [b]
+    while path[-1] != a:
+        path.append(index["pred"][a, path[-1]])
+    path.reverse()
+
+    return [nodes[k] for k in path]
+
+
+# Returns the shortest path from "start" to "finish" as the list of stations it goes through.
+# The start and the finish are virtual nodes connected to every station at walking speed,
+# so the graph is never modified and may be shared by concurrent queries.
+# On a LazyGraph the first and the last stations may be restricted to some "origins" and
+# "destinations" (see lazy_path).
+def compute_path(G, start, finish, origins=None, destinations=None):
+    if isinstance(G, LazyGraph):
+        return lazy_path(G, start, finish, origins, destinations)
+    if origins is not None or destinations is not None:
+        raise ValueError("Only the routes on a LazyGraph can be restricted to some stations")
+    if isinstance(G, StationGraph):
+        return station_graph_path(G, start, finish)
+    if "routing" in G.graph:
+        return indexed_path(G, start, finish)
+
+    nodes, lat, lon = station_arrays(G)
+    if not nodes:
+        raise ValueError("The graph has no stations")
+    walk_start = haversine_array(start[0], start[1], lat, lon) / 4
+    walk_finish = dict(zip(nodes, haversine_array(finish[0], finish[1], lat, lon) / 4))
+
+    # Dijkstra with every station as a source, at the cost of walking to it from the start.
+    # The counter breaks ties without comparing the stations themselves.
+    counter = count()
+    heap = [(cost, next(counter), node, None) for node, cost in zip(nodes, walk_start)]
+    heapq.heapify(heap)
+
+    previous = dict()
+    best_cost, best_node = float("inf"), None
+    while heap:
+        cost, _, node, prev = heapq.heappop(heap)
+        if node in previous:
+            continue
+        # Walking from any remaining station to the finish can not be shorter
+        if cost >= best_cost:
+            break
+        previous[node] = prev
 
-    # Compute the shortest path from S to F
-    path = nx.dijkstra_path(G, "S", "F")
+        if cost + walk_finish[node] < best_cost:
+            best_cost, best_node = cost + walk_finish[node], node
+
+        for neighbour, attr in G.adj[node].items():
+            if neighbour not in previous:
+                heapq.heappush(heap, (cost + attr["weight"], next(counter), neighbour, node))
+
+    # Rebuild the path from the last station
+    path = [best_node]
+    while previous[path[-1]] is not None:
+        path.append(previous[path[-1]])
+    path.reverse()
 
     return path
 
 
-# Draws the path P.
-def draw_path(G, P):
-    map_bcn = StaticMap(600, 600)
+# Draws the path P of stations, walking from "start" and to "finish".
+# Returns the image as a PNG file in memory.
+def draw_path(G, P, start, finish, size=600):
+    from staticmap import CircleMarker, Line
+    map_bcn = render.new_map(size, size)
 
-    coord1 = (G.node[P[0]]["lon"], G.node[P[0]]["lat"])
+    coords = [(start[1], start[0])]
+    coords += [(G.node[station]["lon"], G.node[station]["lat"]) for station in P]
+    coords.append((finish[1], finish[0]))
+
+    coord1 = coords[0]
     marker = CircleMarker(coord1, "red", 2)
     map_bcn.add_marker(marker)
 
-    for i in range(1, len(P)):
+    for coord2 in coords[1:]:
         # Represent a station
-        coord2 = (G.node[P[i]]["lon"], G.node[P[i]]["lat"])
         marker = CircleMarker(coord2, "red", 2)
         map_bcn.add_marker(marker)
 
@@ -67,39 +186,78 @@ def draw_path(G, P):
         map_bcn.add_line(line)
 
     # Obtain the final image
-    image = map_bcn.render()
-    image.save("path.png")
+    with metrics.timed("bicing_stage_seconds", stage="render"):
+        image = map_bcn.render()
+    return render.to_png(image)
+
+
+# Returns the geocoder used to find addresses, creating it the first time.
+def get_geocoder():
+    global geocoder
+    if geocoder is None:
+        geocoder = geocoding.Geocoder()
+    return geocoder
 
 
 # Returns the coordinates of the two given addresses.
 def get_coords(addresses):
     try:
-        geolocator = geo.Nominatim(user_agent="bicing_bot")
         address1, address2 = addresses.split(',')
-        location1 = geolocator.geocode(address1 + ', Barcelona')
-        location2 = geolocator.geocode(address2 + ', Barcelona')
-        return (location1.latitude, location1.longitude), (location2.latitude, location2.longitude)
+        with metrics.timed("bicing_stage_seconds", stage="geocoding"):
+            location1, location2 = get_geocoder().locate_all([address1, address2])
+        return location1, location2
     except:
         raise ValueError("Address not found")
 
 
-# Creates an image with the shortest path from "start" to "finish".
-def shortest_path(G, addresses):
+# Returns the shortest path between the two given addresses, along with their coordinates.
+# The first and the last stations may be restricted like in compute_path.
+def find_route(G, addresses, origins=None, destinations=None):
     coords = get_coords(addresses)
     start, finish = coords
     if start == finish:
         raise ValueError("Both addresses are the same")
 
-    # Add the two new nodes
-    G.add_node("S", lat=start[0], lon=start[1])
-    G.add_node("F", lat=finish[0], lon=finish[1])
+    with metrics.timed("bicing_stage_seconds", stage="routing"):
+        path = compute_path(G, start, finish, origins, destinations)
+    return path, start, finish
+
+
+# Returns a distance in km as text, in meters if it is shorter than a km.
+def text_distance(km):
+    if km < 1:
+        return "%d m" % round(km * 1000)
+    return "%.1f km" % km
 
-    path = compute_path(G, start, finish)
-    draw_path(G, path)
 
-    # Return the graph to its original state
-    G.remove_node("S")
-    G.remove_node("F")
+# Returns a summary of the path P of stations from "start" to "finish": the distances walked
+# and ridden, the bikes and docks of the first and the last stations in "bikes", if given,
+# and the time it takes.
+def text_route(G, P, start, finish, bikes=None):
+    coords = [(G.node[station]["lat"], G.node[station]["lon"]) for station in P]
+    walk_start, walk_finish = haversine(start, coords[0]), haversine(coords[-1], finish)
+    ride = sum(haversine(a, b) for a, b in zip(coords, coords[1:]))
+
+    first, last = "station %s" % P[0], "station %s" % P[-1]
+    if bikes is not None and P[0] in bikes.index and P[-1] in bikes.index:
+        first += " (%d bikes)" % bikes.at[P[0], "num_bikes_available"]
+        last += " (%d docks)" % bikes.at[P[-1], "num_docks_available"]
+    minutes = round(((walk_start + walk_finish) / 4 + ride / 10) * 60)
+    return "\n".join(["Walk %s to %s" % (text_distance(walk_start), first),
+                      "Ride %s to %s" % (text_distance(ride), last),
+                      "Walk %s to the destination" % text_distance(walk_finish),
+                      "About %d minutes" % minutes])
+
+
+# Returns an image with the shortest path from "start" to "finish".
+def shortest_path(G, addresses):
+    path, start, finish = find_route(G, addresses)
+    return draw_path(G, path, start, finish)
+
+
+# Returns the dataframe of the stations of a GBFS feed (already parsed from json).
+def feed_dataframe(feed):
+    return pd.DataFrame.from_records(feed['data']['stations'], index='station_id')
 
 
 # Return the downloaded dataframe from the web.
@@ -107,11 +265,13 @@ def get_dataframe(flow=False):
     try:
         # The main dataframe with stations and coordinates
         url_info = 'https://api.bsmsa.eu/ext/api/bsm/gbfs/v2/en/station_information'
-        stations = pd.DataFrame.from_records(pd.read_json(url_info)['data']['stations'], index='station_id')
+        with metrics.timed("bicing_stage_seconds", stage="get_dataframe"):
+            stations = feed_dataframe(pd.read_json(url_info))
 
         if flow:  # The dataframe for the distribute command
             url_status = 'https://api.bsmsa.eu/ext/api/bsm/gbfs/v2/en/station_status'
-            bikes = pd.DataFrame.from_records(pd.read_json(url_status)['data']['stations'], index='station_id')
+            with metrics.timed("bicing_stage_seconds", stage="get_dataframe"):
+                bikes = feed_dataframe(pd.read_json(url_status))
             return stations, bikes
 
         else:
@@ -121,9 +281,10 @@ def get_dataframe(flow=False):
         raise ValueError("Could not download the data")
 
 
-# Creates an image of the graph.
-def draw_graph(G):
-    map_bcn = StaticMap(600, 600)
+# Creates an image of the graph. Returns it as a PNG file in memory.
+def draw_graph(G, size=600):
+    from staticmap import CircleMarker, Line
+    map_bcn = render.new_map(size, size)
 
     # Thinner lines if there are many edges
     rel_width = 5
@@ -142,8 +303,9 @@ def draw_graph(G):
         marker = CircleMarker((G.node[u]["lon"], G.node[u]["lat"]), 'red', 2)
         map_bcn.add_marker(marker)
 
-    image = map_bcn.render()
-    image.save('stations.png')
+    with metrics.timed("bicing_stage_seconds", stage="render"):
+        image = map_bcn.render()
+    return render.to_png(image)
 
 
 # Prepares the DiGraph so that we can apply the network_simplex function on it later.
@@ -191,13 +353,149 @@ def add_nodes(G, demand, stations, bikes):
     G.nodes['TOP']['demand'] = -demand
 
 
+# Returns, for every station with b bikes and d docks, the bikes it must receive and give to
+# fit the demand, and the ones it may give and receive on top of those (negative if it can not
+# even cover what it must).
+def station_requirements(demand, b, d):
+    requiredBikes, requiredDocks = demand
+
+    # As in add_nodes, a station that needs bikes is not asked for docks
+    req_bikes = np.maximum(0, requiredBikes - b)
+    req_docks = np.where(req_bikes > 0, 0, np.maximum(0, requiredDocks - d))
+    give = np.maximum(0, b - requiredBikes) - req_docks
+    receive = np.maximum(0, d - requiredDocks) - req_bikes
+    return req_bikes, req_docks, give, receive
+
+
+# Returns which of the n stations are in a component, of the graph with the edges (i, j),
+# where some station is forced to give or receive bikes.
+def forced_components(n, i, j, forced):
+    adjacency = csr_matrix((np.ones(len(i)), (i, j)), shape=(n, n))
+    labels = connected_components(adjacency, directed=False)[1]
+    return np.isin(labels, labels[forced])
+
+
+# Returns the flow network of the distribution with only what the solver needs, which has the
+# same optimal cost as the one of add_nodes and connect_graph. The s and t nodes of every
+# station are folded into its g node: the bikes it must give or receive become the demand of
+# g, and the ones it may give or receive on top of those become edges from or to TOP. Stations
+# whose component has nothing forced are left out, since no bike needs to move there.
+# With k, every station is only connected to its k nearest ones within the distance, which is
+# faster but may give a higher cost or no distribution at all.
+def reduced_network(demand, dist, stations, bikes, k=None):
+    bikes = bikes[bikes.index.isin(stations.index)]
+    nodes = list(bikes.index)
+    lat = stations["lat"].reindex(nodes).to_numpy(dtype=float)
+    lon = stations["lon"].reindex(nodes).to_numpy(dtype=float)
+    b = bikes['num_bikes_available'].to_numpy(dtype=int)
+    d = bikes['num_docks_available'].to_numpy(dtype=int)
+
+    req_bikes, req_docks, give, receive = station_requirements(demand, b, d)
+    if (give < 0).any() or (receive < 0).any():
+        raise ValueError("impossible")
+
+    if float(dist) > 0 and len(nodes) > 1:
+        i, j, l = candidate_pairs(lat, lon, float(dist) / 1000)
+    else:
+        i = j = np.zeros(0, dtype=int)
+        l = np.zeros(0)
+    if k is not None:
+        i, j, l = nearest_pairs(i, j, l, k)
+
+    keep = forced_components(len(nodes), i, j, (req_bikes > 0) | (req_docks > 0))
+    edges = keep[i]  # both ends are in the same component
+
+    G = nx.DiGraph()
+    G.add_node('TOP', demand=int(req_docks.sum() - req_bikes.sum()))
+    for x in np.flatnonzero(keep).tolist():
+        g_idx = 'g' + str(nodes[x])
+        G.add_node(g_idx, lat=lat[x], lon=lon[x], demand=int(req_bikes[x] - req_docks[x]))
+        if give[x] > 0:
+            G.add_edge('TOP', g_idx, capacity=int(give[x]))
+        if receive[x] > 0:
+            G.add_edge(g_idx, 'TOP', capacity=int(receive[x]))
+    add_edges(G, ['g' + str(node) for node in nodes], i[edges], j[edges], l[edges], flow=True)
+    return G
+
+
+# Keeps only the pairs (i, j) where j is among the k nearest of i, or i among the k nearest of j.
+def nearest_pairs(i, j, l, k):
+    ends = np.concatenate((i, j))
+    order = np.lexsort((np.concatenate((l, l)), ends))  # by end, then by distance
+    ends = ends[order]
+    rank = np.arange(len(ends)) - np.searchsorted(ends, ends)  # position among the pairs of its end
+    near = np.zeros(len(ends), dtype=bool)
+    near[order] = rank < k
+    near = near[:len(i)] | near[len(i):]
+    return i[near], j[near], l[near]
+
+
+# Returns the cost, the flow (an array) and the potentials of the nodes of the minimum cost flow
+# of the network with n nodes and the edges tail -> head with the given costs and capacities,
+# where node v must receive demand[v] more than it sends. Solved with scipy's HiGHS as a linear
+# program: the constraint matrix of a flow is totally unimodular, so the optimal flow is integral.
+# The flow is still optimal after adding an edge u -> v as long as its cost is not below
+# potentials[v] - potentials[u].
+def highs_solve(n, tail, head, cost, capacity, demand):
+    m = len(tail)
+    if m == 0:  # linprog does not accept a problem without variables
+        if np.any(demand):
+            raise nx.NetworkXUnfeasible("no flow satisfies all node demands")
+        return 0, np.zeros(0, dtype=int), np.zeros(n)
+    from scipy.optimize import linprog
+
+    # For every node, what comes in minus what goes out equals its demand
+    rows = np.concatenate((tail, head))
+    cols = np.concatenate((np.arange(m), np.arange(m)))
+    signs = np.concatenate((-np.ones(m), np.ones(m)))
+    A = csr_matrix((signs, (rows, cols)), shape=(n, m))
+
+    result = linprog(cost, A_eq=A, b_eq=demand, bounds=np.column_stack((np.zeros(m), capacity)), method="highs")
+    if result.status != 0:
+        raise nx.NetworkXUnfeasible("no flow satisfies all node demands")
+
+    flow = np.rint(result.x).astype(int)
+    return int(np.dot(cost, flow)), flow, result.eqlin.marginals
+
+
+# Returns the cost and the flow (a dictionary like the one of nx.network_simplex) of the
+# minimum cost flow of G, solved with highs_solve.
+def highs_flow(G):
+    nodes = list(G.nodes())
+    position = {node: k for k, node in enumerate(nodes)}
+    edges = list(G.edges(data=True))
+
+    tail = np.array([position[u] for u, v, attr in edges], dtype=int)
+    head = np.array([position[v] for u, v, attr in edges], dtype=int)
+    cost = np.array([attr.get("weight", 0) for u, v, attr in edges], dtype=float)
+    capacity = np.array([attr.get("capacity", np.inf) for u, v, attr in edges], dtype=float)
+    demand = np.array([G.nodes[node].get("demand", 0) for node in nodes], dtype=float)
+
+    flowCost, flow, potentials = highs_solve(len(nodes), tail, head, cost, capacity, demand)
+    flowDict = {node: dict() for node in nodes}
+    for (u, v, attr), f in zip(edges, flow.tolist()):
+        flowDict[u][v] = f
+    return flowCost, flowDict
+
+
+# Returns the cost and the flow of the minimum cost flow of G, computed with the given solver:
+# "highs" (the fastest) or "network_simplex" (the reference one).
+def solve_flow(G, solver=FLOW_SOLVER):
+    if solver == "network_simplex":
+        return nx.network_simplex(G)
+    elif solver == "highs":
+        return highs_flow(G)
+    raise ValueError("Unknown solver " + str(solver))
+
+
 # Returns the total transference cost and the maximum among the costs
 # for transfering bikes through each edge of the edges.
-def text_flow(G, bikes):
+def text_flow(G, bikes, solver=FLOW_SOLVER):
     err = False
 
     try:
-        flowCost, flowDict = nx.network_simplex(G)
+        with metrics.timed("bicing_stage_seconds", stage="solve_flow", solver=solver):
+            flowCost, flowDict = solve_flow(G, solver)
 
     except nx.NetworkXUnfeasible:
         err = True
@@ -234,15 +532,125 @@ def text_flow(G, bikes):
 
 
 # Returns the information of the cost of distributing the bycicles according to the demand.
-def minflow(demand, dist, sts_bikes):
-    G = nx.DiGraph()
+# With reduced=False the whole network of add_nodes is solved instead of the one of
+# reduced_network, and k is passed to the latter.
+def minflow(demand, dist, sts_bikes, solver=FLOW_SOLVER, reduced=True, k=None):
     stations, bikes = sts_bikes
-    add_nodes(G, demand, stations, bikes)
+    if reduced:
+        G = reduced_network(demand, dist, stations, bikes, k)
+    else:
+        G = nx.DiGraph()
+        add_nodes(G, demand, stations, bikes)
+        G = build_graph(dist, G, flow=True)
+
+    info = text_flow(G, bikes, solver)
+    return info
 
-    G = build_graph(dist, G, flow=True)
 
-    info = text_flow(G, bikes)
-    return info
+# Same as minflow, but also returns the bikes of the stations after the distribution,
+# for callers that do not share them with minflow (e.g. when it runs in another process).
+def distribute_bikes(demand, dist, sts_bikes, solver=FLOW_SOLVER, reduced=True):
+    info = minflow(demand, dist, sts_bikes, solver, reduced)
+    return info, sts_bikes[1]
+
+
+# Returns the cost (in km) of the distribution of the stations with b bikes and d docks for
+# the given demand and each of the n_dists distances, or None where it is not possible, solving
+# the same network as reduced_network. The distances go from the smallest to the largest one,
+# and the pair (i[x], j[x]) of stations, of length l[x] (in km), is an edge from the distance
+# first[x] on. The distances before "start" are known to be impossible and are not solved.
+def sweep_costs(demand, b, d, i, j, l, first, n_dists, start=0):
+    n = len(b)
+    req_bikes, req_docks, give, receive = station_requirements(demand, b, d)
+    if (give < 0).any() or (receive < 0).any():
+        return [None] * n_dists
+
+    # The stations are the nodes 0 to n-1 and TOP is the node n. The edges between stations go
+    # first, in both directions, and then the ones from and to TOP.
+    given, received = np.flatnonzero(give > 0), np.flatnonzero(receive > 0)
+    tail = np.concatenate((i, j, np.full(len(given), n), received))
+    head = np.concatenate((j, i, given, np.full(len(received), n)))
+    cost = np.concatenate(((l * 1000).astype(int),) * 2 + (np.zeros(len(given) + len(received), dtype=int),))
+    capacity = np.concatenate((np.full(2 * len(i), np.inf), give[given], receive[received]))
+    demand_nodes = np.append(req_bikes - req_docks, req_docks.sum() - req_bikes.sum())
+    level = np.concatenate((first, first, np.zeros(len(given) + len(received), dtype=int)))
+
+    costs = [None] * n_dists
+    best = None  # the cost and the potentials of the last flow found
+    for k in range(start, n_dists):
+        # The last flow is still the best one if no new edge is cheaper than its potentials allow
+        new = np.flatnonzero(level == k) if k > start else []
+        if best is not None and (cost[new] >= best[1][head[new]] - best[1][tail[new]] - 1e-6).all():
+            costs[k] = best[0]
+            continue
+
+        edges = np.flatnonzero(level <= k)
+        try:
+            flowCost, flow, potentials = highs_solve(n + 1, tail[edges], head[edges], cost[edges],
+                                                     capacity[edges], demand_nodes)
+        except nx.NetworkXUnfeasible:
+            continue
+        best = (flowCost / 1000, potentials)
+        costs[k] = best[0]
+    return costs
+
+
+# Returns a table with the cost (in km) of distributing the bikes for every demand (rows) and
+# distance (columns), NaN where it is not possible, without modifying the bikes. The pairs of
+# stations are computed once for all the distances, or taken from "pairs" (the PairTable of the
+# stations) when given. Every demand is solved from the smallest distance to the largest one,
+# and a flow is only solved again when the new edges could make it cheaper. Needing more bikes
+# or docks, or a smaller distance, can only make the distribution harder, so what is known to be
+# impossible is not solved again. With an executor (e.g. a ProcessPoolExecutor), the demands are
+# solved in parallel.
+def distribute_sweep(demands, dists, sts_bikes, pairs=None, executor=None):
+    stations, bikes = sts_bikes
+    demands = [tuple(int(x) for x in demand) for demand in demands]
+    dists = sorted(set(float(dist) for dist in dists))
+
+    if pairs is None or dists[-1] > pairs.max_dist:
+        pairs = PairTable(stations, max(dists[-1], 0))
+    present = pd.Index(pairs.nodes).isin(bikes.index)
+    position = np.cumsum(present) - 1  # of every station among the present ones
+    rows = bikes.reindex(pd.Index(pairs.nodes)[present])
+    b = rows['num_bikes_available'].to_numpy(dtype=int)
+    d = rows['num_docks_available'].to_numpy(dtype=int)
+
+    # The pairs of the largest distance among the stations with bikes, and the first distance
+    # each of them is an edge for
+    k = pairs.edges(dists[-1]) if dists[-1] > 0 else np.zeros(0, dtype=int)
+    k = k[present[pairs.i[k]] & present[pairs.j[k]]]
+    first = np.full(len(k), len(dists) - 1)
+    for x in range(len(dists) - 2, -1, -1):
+        if dists[x] > 0:
+            first[np.isin(k, pairs.edges(dists[x]))] = x
+    i, j, l = position[pairs.i[k]], position[pairs.j[k]], pairs.l[k]
+
+    results = dict()
+    if executor is None:
+        impossible = dict()  # demand -> number of distances where it is not possible
+        for demand in sorted(demands):
+            start = max([0] + [x for other, x in impossible.items()
+                               if demand[0] >= other[0] and demand[1] >= other[1]])
+            results[demand] = sweep_costs(demand, b, d, i, j, l, first, len(dists), start)
+            impossible[demand] = results[demand].count(None)
+    else:
+        futures = {demand: executor.submit(sweep_costs, demand, b, d, i, j, l, first, len(dists))
+                   for demand in set(demands)}
+        results = {demand: future.result() for demand, future in futures.items()}
+
+    return pd.DataFrame([results[demand] for demand in demands], columns=dists, dtype=float,
+                        index=pd.MultiIndex.from_tuples(demands, names=["bikes", "docks"]))
+
+
+# Returns the table of distribute_sweep as text, with "-" where the distribution is not possible.
+def text_sweep(table):
+    header = "bikes docks" + "".join("%9d" % dist for dist in table.columns)
+    lines = [header]
+    for (nbikes, ndocks), costs in table.iterrows():
+        cells = "".join("%9s" % ("-" if np.isnan(cost) else "%.3f" % cost) for cost in costs)
+        lines.append("%5d %5d" % (nbikes, ndocks) + cells)
+    return "\n".join(lines)
 
 
 # Removes all edges of the graph without modifying the nodes
@@ -332,8 +740,9 @@ def find_extremes(G):
     return bott_left, upper_right
 
 
-# Connects all nodes that are closer than distance dist to each other.
-def connect_graph(G, dist, flow=False):
+# Connects all nodes that are closer than distance dist to each other, comparing
+# every candidate pair one at a time. Kept as a reference for connect_graph.
+def connect_graph_legacy(G, dist, flow=False):
     lat = "lat"
     lon = "lon"
 
@@ -359,9 +768,571 @@ def connect_graph(G, dist, flow=False):
             check_neighbours(M, G, n_lat, n_lon, node, dist, i_j[0], i_j[1], dist_lat, dist_lon, flow)
 
 
-# Creates a graph without edges
-def initialize_graph():
-    BicingData = get_dataframe()
+# Returns the haversine distance (in km) between the coordinates of the given arrays.
+def haversine_array(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    d = (np.sin((lat2 - lat1) * 0.5) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) * 0.5) ** 2)
+    return EARTH_RADIUS * (2 * np.arcsin(np.sqrt(d)))
+
+
+# Returns the nodes of the geometric graph in G and their coordinates as arrays.
+def station_arrays(G):
+    if isinstance(G, StationGraph):
+        return G.station_ids, G.lat, G.lon
+    nodes = [node for node in G.nodes() if str(node)[0] not in ["s", "t", "T"]]
+    lat = np.array([G.node[node]["lat"] for node in nodes], dtype=float)
+    lon = np.array([G.node[node]["lon"] for node in nodes], dtype=float)
+    return nodes, lat, lon
+
+
+# Returns the pairs (i, j) of indices closer than dist km, along with their distance.
+# If "targets" are given, only the pairs with some of those indices are returned.
+def candidate_pairs(lat, lon, dist, targets=None):
+    dist_lat = dist / KM_LAT
+    dist_lon = dist / KM_LON
+
+    # Projected so that the box used by connect_graph_legacy becomes a square of side 2*dist
+    from scipy.spatial import cKDTree
+    points = np.column_stack((lat * KM_LAT, lon * KM_LON))
+    tree = cKDTree(points)
+    if targets is None:
+        pairs = tree.query_pairs(dist, p=np.inf, output_type='ndarray')
+        i, j = pairs[:, 0], pairs[:, 1]
+    else:
+        targets = np.asarray(targets, dtype=int)
+        if len(targets) == 0:
+            return targets, targets, np.zeros(0)
+        neighbours = tree.query_ball_point(points[targets], dist, p=np.inf)
+        i = np.repeat(targets, [len(n) for n in neighbours])
+        j = np.concatenate(neighbours).astype(int)
+
+        # Every pair only once, even when both are targets
+        is_target = np.zeros(len(lat), dtype=bool)
+        is_target[targets] = True
+        keep = (i != j) & (~is_target[j] | (i < j))
+        i, j = i[keep], j[keep]
+
+    inside = (np.abs(lat[i] - lat[j]) < dist_lat) & (np.abs(lon[i] - lon[j]) < dist_lon)
+    i, j = i[inside], j[inside]
+    l = haversine_array(lat[i], lon[i], lat[j], lon[j])
+
+    close = l <= dist
+    return i[close], j[close], l[close]
+
+
+# Adds the edges between nodes[i] and nodes[j] of length l (in km) to G.
+def add_edges(G, nodes, i, j, l, flow=False):
+    nodes = np.array(nodes, dtype=object)
+    if not flow:
+        G.add_weighted_edges_from(zip(nodes[i], nodes[j], l / 10))
+    else:
+        weights = [int(w) for w in l * 1000]
+        G.add_weighted_edges_from(zip(nodes[i], nodes[j], weights))
+        G.add_weighted_edges_from(zip(nodes[j], nodes[i], weights))
+
+
+# Connects all nodes that are closer than distance dist to each other.
+def connect_graph(G, dist, flow=False, legacy=False):
+    if legacy:
+        connect_graph_legacy(G, dist, flow)
+        return
+
+    nodes, lat, lon = station_arrays(G)
+    if len(nodes) < 2:
+        return
+
+    i, j, l = candidate_pairs(lat, lon, dist / 1000)
+    add_edges(G, nodes, i, j, l, flow)
+
+
+# The pairs of stations closer than "max_dist" meters, sorted by distance, so that the edges
+# of the graph of any smaller distance are a prefix of them. The number of connected components
+# for every distance is obtained from the distances at which a union-find over the sorted
+# pairs merges two components.
+class PairTable:
+
+    def __init__(self, stations, max_dist=MAX_DIST):
+        self.nodes = list(stations.index)
+        self.lat = stations["lat"].to_numpy(dtype=float)
+        self.lon = stations["lon"].to_numpy(dtype=float)
+        self.max_dist = max_dist
+
+        # Sorted by the farthest of the distance and the sides of the box checked by connect_graph,
+        # so that a pair may only be an edge for distances above that value
+        i, j, l = candidate_pairs(self.lat, self.lon, max_dist / 1000)
+        reach = np.maximum(l, np.maximum(np.abs(self.lat[i] - self.lat[j]) * KM_LAT,
+                                          np.abs(self.lon[i] - self.lon[j]) * KM_LON))
+        order = np.argsort(reach, kind="stable")
+        self.i, self.j, self.l, self.reach = i[order], j[order], l[order], reach[order]
+
+        self.merges = self.merge_distances()
+
+    # Returns the sorted distances (in km) at which two components are merged.
+    def merge_distances(self):
+        parent = list(range(len(self.nodes)))
+
+        def find(x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        merges = []
+        for a, b, r in zip(self.i.tolist(), self.j.tolist(), self.reach.tolist()):
+            a, b = find(a), find(b)
+            if a != b:
+                parent[a] = b
+                merges.append(r)
+        return np.array(merges)
+
+    # Returns the memory used by the table, in bytes.
+    def nbytes(self):
+        return self.i.nbytes + self.j.nbytes + self.l.nbytes + self.reach.nbytes + self.merges.nbytes
+
+    # Returns the indices of the pairs that are edges of the graph with distance dist (in meters).
+    def edges(self, dist):
+        dist = dist / 1000
+        k = np.searchsorted(self.reach, dist, side="right")
+        i, j, l = self.i[:k], self.j[:k], self.l[:k]
+        inside = ((np.abs(self.lat[i] - self.lat[j]) < dist / KM_LAT) &
+                  (np.abs(self.lon[i] - self.lon[j]) < dist / KM_LON) & (l <= dist))
+        return np.flatnonzero(inside)
+
+    # Returns the number of connected components of the graph with distance dist.
+    def components(self, dist):
+        if dist <= 0:
+            return len(self.nodes)
+        return len(self.nodes) - int(np.searchsorted(self.merges, dist / 1000, side="right"))
+
+    # Connects the nodes of G (the stations of the table) as in the graph with distance dist.
+    def connect(self, G, dist):
+        k = self.edges(dist)
+        add_edges(G, self.nodes, self.i[k], self.j[k], self.l[k])
+
+    # Returns the arrays of the table, from which it is created again by from_arrays.
+    def arrays(self):
+        return {"nodes": np.array(self.nodes), "lat": self.lat, "lon": self.lon, "max_dist": np.array(self.max_dist),
+                "i": self.i, "j": self.j, "l": self.l, "reach": self.reach, "merges": self.merges}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        pairs = cls.__new__(cls)
+        pairs.nodes = arrays["nodes"].tolist()
+        pairs.max_dist = arrays["max_dist"].item()
+        for name in ["lat", "lon", "i", "j", "l", "reach", "merges"]:
+            setattr(pairs, name, arrays[name])
+        return pairs
+
+
+# The coordinates of the stations of a StationGraph, looked up as G.node[station]["lat"]
+# like in a networkx graph.
+class StationView:
+
+    def __init__(self, G):
+        self.G = G
+
+    def __getitem__(self, station):
+        k = self.G.index[station]
+        return {"lat": self.G.lat[k], "lon": self.G.lon[k]}
+
+
+# A graph of stations stored in arrays instead of networkx dictionaries: the stations are
+# numbered from 0 to n-1, their coordinates are kept in two arrays and the edges in a
+# symmetric sparse matrix (CSR) of weights. It has the methods of networkx graphs used to
+# count and draw, so it can be used wherever a graph of stations is expected.
+class StationGraph:
+
+    def __init__(self, station_ids, lat, lon, i, j, w):
+        self.station_ids = list(station_ids)
+        self.index = {station: k for k, station in enumerate(self.station_ids)}
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = np.asarray(lon, dtype=float)
+        self.node = StationView(self)
+
+        n = len(self.station_ids)
+        rows, cols = np.concatenate((i, j)), np.concatenate((j, i))
+        self.adjacency = csr_matrix((np.concatenate((w, w)), (rows, cols)), shape=(n, n))
+        self.n_edges = len(i)
+
+    def number_of_nodes(self):
+        return len(self.station_ids)
+
+    def number_of_edges(self):
+        return self.n_edges
+
+    def nodes(self):
+        return self.station_ids
+
+    def edges(self):
+        upper = triu(self.adjacency).tocoo()
+        return [(self.station_ids[u], self.station_ids[v]) for u, v in zip(upper.row, upper.col)]
+
+    # Returns the memory used by the arrays of the graph, in bytes.
+    def nbytes(self):
+        return (self.lat.nbytes + self.lon.nbytes + self.adjacency.data.nbytes +
+                self.adjacency.indices.nbytes + self.adjacency.indptr.nbytes)
+
+    # Returns the arrays of the graph, from which it is created again by from_arrays.
+    def arrays(self):
+        return {"nodes": np.array(self.station_ids), "lat": self.lat, "lon": self.lon,
+                "n_edges": np.array(self.n_edges), "data": self.adjacency.data,
+                "indices": self.adjacency.indices, "indptr": self.adjacency.indptr}
+
+    # Returns the graph of the arrays of arrays() without copying them, so that the graph read
+    # from memory-mapped files keeps using them.
+    @classmethod
+    def from_arrays(cls, arrays):
+        G = cls.__new__(cls)
+        G.station_ids = arrays["nodes"].tolist()
+        G.index = {station: k for k, station in enumerate(G.station_ids)}
+        G.lat, G.lon = arrays["lat"], arrays["lon"]
+        G.node = StationView(G)
+        # Given as plain arrays, as scipy copies the np.memmaps
+        n = len(G.station_ids)
+        csr = tuple(np.asarray(arrays[name]) for name in ["data", "indices", "indptr"])
+        G.adjacency = csr_matrix(csr, shape=(n, n), copy=False)
+        G.n_edges = arrays["n_edges"].item()
+        return G
+
+
+# Returns a StationGraph of the given stations with distance dist, taking its edges
+# from the table of pairs if given.
+def build_station_graph(dist=1000, stations=None, pairs=None):
+    if stations is None:
+        stations = get_dataframe()
+    lat = stations["lat"].to_numpy(dtype=float)
+    lon = stations["lon"].to_numpy(dtype=float)
+
+    if float(dist) <= 0:
+        i = j = np.zeros(0, dtype=int)
+        l = np.zeros(0)
+    elif pairs is not None and float(dist) <= pairs.max_dist:
+        k = pairs.edges(float(dist))
+        i, j, l = pairs.i[k], pairs.j[k], pairs.l[k]
+    else:
+        i, j, l = candidate_pairs(lat, lon, float(dist) / 1000)
+
+    return StationGraph(stations.index, lat, lon, i, j, l / 10)
+
+
+# Returns the shortest path from "start" to "finish" in a StationGraph, with a Dijkstra
+# from the start on a copy of its matrix with the start connected to every station.
+def station_graph_path(G, start, finish):
+    n = G.number_of_nodes()
+    if n == 0:
+        raise ValueError("The graph has no stations")
+    walk_start = haversine_array(start[0], start[1], G.lat, G.lon) / 4
+    walk_finish = haversine_array(finish[0], finish[1], G.lat, G.lon) / 4
+
+    # The start is the node n
+    start_row = csr_matrix((walk_start, (np.zeros(n, dtype=int), np.arange(n))), shape=(1, n + 1))
+    matrix = vstack([hstack([G.adjacency, csr_matrix((n, 1))]), start_row]).tocsr()
+    dist, pred = dijkstra(matrix, directed=True, indices=n, return_predecessors=True)
+
+    # Rebuild the path from the best last station
+    path = [int(np.argmin(dist[:n] + walk_finish))]
+    while pred[path[-1]] != n:
+        path.append(pred[path[-1]])
+    path.reverse()
+
+    return [G.station_ids[k] for k in path]
+
+
+# A spatial index of the stations: their coordinates and a KD-tree of them, projected so that
+# the box checked by connect_graph becomes a square. It answers which stations would be
+# neighbours of a given one in the graph of any distance, without building the graph.
+class StationIndex:
+
+    def __init__(self, stations):
+        self.station_ids = list(stations.index)
+        self.index = {station: k for k, station in enumerate(self.station_ids)}
+        self.lat = stations["lat"].to_numpy(dtype=float)
+        self.lon = stations["lon"].to_numpy(dtype=float)
+        from scipy.spatial import cKDTree
+        self.tree = cKDTree(np.column_stack((self.lat * KM_LAT, self.lon * KM_LON)))
+
+    # Returns the positions of the neighbours of the station at position k in the graph with
+    # distance dist (in km), and their distances to it, like connect_graph would connect them.
+    def neighbours(self, k, dist):
+        near = np.array(self.tree.query_ball_point(self.tree.data[k], dist, p=np.inf), dtype=int)
+        near = near[(near != k) & (np.abs(self.lat[near] - self.lat[k]) < dist / KM_LAT) &
+                    (np.abs(self.lon[near] - self.lon[k]) < dist / KM_LON)]
+        l = haversine_array(self.lat[k], self.lon[k], self.lat[near], self.lon[near])
+        return near[l <= dist], l[l <= dist]
+
+    # Returns the subset of all the stations, which shares the KD-tree of the index.
+    def all(self):
+        return StationSubset(self, np.arange(len(self.station_ids)))
+
+    # Returns the subset of the stations whose value of the given column of the status (a
+    # dataframe like the bikes of a snapshot) is above the threshold, e.g. the ones with bikes.
+    # The stations missing from the status are left out.
+    def available(self, bikes, column, threshold=0):
+        values = bikes[column].reindex(self.station_ids).fillna(0).to_numpy()
+        return StationSubset(self, np.flatnonzero(values > threshold))
+
+    # Returns the memory used by the index, roughly, in bytes.
+    def nbytes(self):
+        return self.lat.nbytes * 6
+
+
+# Some of the stations of a StationIndex (e.g. the ones with bikes), with a KD-tree of their own,
+# so that the nearest ones to a place are found without looking at the others. The tree is on the
+# projected coordinates, which are within 2% of the haversine distances around Barcelona, so the
+# candidates are checked with the exact distance.
+class StationSubset:
+
+    MARGIN = 1.02
+
+    def __init__(self, index, positions):
+        self.station_index = index
+        self.positions = np.asarray(positions, dtype=int)
+        self.mask = np.zeros(len(index.station_ids), dtype=bool)  # whether every station is in it
+        self.mask[self.positions] = True
+        if len(self.positions) == len(index.station_ids):
+            self.tree = index.tree
+        elif len(self.positions) > 0:
+            from scipy.spatial import cKDTree
+            self.tree = cKDTree(index.tree.data[self.positions])
+        else:
+            self.tree = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    # Returns the positions (in the index) of the stations of the subset within dist km of the
+    # given coordinates (all of them if dist is infinite), and their distances, from the nearest
+    # to the farthest.
+    def within(self, lat, lon, dist):
+        if self.tree is None or dist < 0:
+            return np.zeros(0, dtype=int), np.zeros(0)
+        if np.isinf(dist):
+            return self.closest(lat, lon, np.arange(len(self.positions)), dist)
+        near = np.array(self.tree.query_ball_point((lat * KM_LAT, lon * KM_LON), dist * self.MARGIN), dtype=int)
+        return self.closest(lat, lon, near, dist)
+
+    # Returns the position (in the index) of a station of the subset near the given coordinates:
+    # the nearest one in the projection, which may not be the nearest one. None if it is empty.
+    def near(self, lat, lon):
+        if self.tree is None:
+            return None
+        return int(self.positions[self.tree.query((lat * KM_LAT, lon * KM_LON))[1]])
+
+    # Returns the positions (in the index) of the k stations of the subset nearest to the given
+    # coordinates, and their distances, from the nearest to the farthest.
+    def nearest(self, lat, lon, k):
+        if self.tree is None or k <= 0:
+            return np.zeros(0, dtype=int), np.zeros(0)
+        point = (lat * KM_LAT, lon * KM_LON)
+        d, _ = self.tree.query(point, min(k, len(self.positions)))
+        # Any station nearer than the k-th found could have been left out by the projection
+        near = np.array(self.tree.query_ball_point(point, np.max(d) * self.MARGIN ** 2), dtype=int)
+        positions, l = self.closest(lat, lon, near, np.inf)
+        return positions[:k], l[:k]
+
+    # Returns the haversine distances from the given coordinates to the stations at the given
+    # positions of the tree.
+    def distances(self, lat, lon, near):
+        index = self.station_index
+        return haversine_array(lat, lon, index.lat[self.positions[near]], index.lon[self.positions[near]])
+
+    # Returns the stations at the given positions of the tree within dist km, sorted by distance.
+    def closest(self, lat, lon, near, dist):
+        l = self.distances(lat, lon, near)
+        order = np.argsort(l, kind="stable")
+        order = order[l[order] <= dist]
+        return self.positions[near[order]], l[order]
+
+
+# The columns of the status that /nearest filters by.
+NEAREST_COLUMNS = {"bikes": "num_bikes_available", "docks": "num_docks_available"}
+
+
+# Returns the k stations nearest to the given coordinates (lat, lon), among the ones with more
+# bikes or docks (kind) than the threshold in the status "bikes", or among all if kind is None.
+# A subset of the stations of the index may be given instead, e.g. a precomputed one.
+# Returns a dataframe indexed by station, with their distance in meters and their bikes and docks.
+def nearest_stations(index, bikes, coords, kind=None, k=3, threshold=0, subset=None):
+    if subset is None:
+        if kind is None:
+            subset = index.all()
+        elif kind in NEAREST_COLUMNS:
+            subset = index.available(bikes, NEAREST_COLUMNS[kind], threshold)
+        else:
+            raise ValueError("Stations can only be filtered by bikes or docks")
+    positions, l = subset.nearest(coords[0], coords[1], k)
+
+    stations = [index.station_ids[p] for p in positions]
+    status = bikes.reindex(stations)[list(NEAREST_COLUMNS.values())].fillna(0).astype(int)
+    return pd.DataFrame({"distance": np.rint(l * 1000).astype(int),
+                         "bikes": status["num_bikes_available"].to_numpy(),
+                         "docks": status["num_docks_available"].to_numpy()},
+                        index=pd.Index(stations, name="station_id"))
+
+
+# Returns the table of nearest_stations as text, with the names of the stations if known.
+def text_nearest(table, stations):
+    if table.empty:
+        return "No station found"
+    lines = []
+    for station, row in table.iterrows():
+        name = str(station)
+        if "name" in stations.columns and station in stations.index:
+            name = str(stations.at[station, "name"])
+        lines.append("%s: %d m, %d bikes, %d docks" % (name, row["distance"], row["bikes"], row["docks"]))
+    return "\n".join(lines)
+
+
+# The graph of the stations with distance dist (in meters) whose edges are only built when they
+# are needed: the routes are searched on it by lazy_path, which asks for the neighbours of the
+# stations it reaches, and they are kept for the next routes. Its stations are looked up as
+# G.node[station]["lat"] like in a networkx graph.
+# If the StationGraph of the same stations and distance is given, the neighbours are read from
+# its matrix instead (e.g. memory-mapped, see cache.GraphCache) and nothing is kept.
+class LazyGraph:
+
+    def __init__(self, index, dist, graph=None):
+        self.station_index = index
+        self.dist = float(dist)
+        self.graph = graph
+        self.station_ids, self.index, self.lat, self.lon = index.station_ids, index.index, index.lat, index.lon
+        self.node = StationView(self)
+        self.adjacency = dict()  # position of a station -> positions of its neighbours and their costs
+
+    # Returns the positions of the neighbours of the station at position k and the cost of riding to them.
+    def neighbours(self, k):
+        if self.graph is not None:
+            matrix = self.graph.adjacency
+            row = slice(matrix.indptr[k], matrix.indptr[k + 1])
+            return matrix.indices[row].tolist(), matrix.data[row].tolist()
+        if k not in self.adjacency:
+            near, l = self.station_index.neighbours(k, self.dist / 1000)
+            self.adjacency[k] = (near.tolist(), (l / 10).tolist())
+        return self.adjacency[k]
+
+    def __getstate__(self):  # the edges are not sent to other processes, they are built again
+        state = self.__dict__.copy()
+        state["adjacency"], state["graph"] = dict(), None
+        return state
+
+    def number_of_nodes(self):
+        return len(self.station_ids)
+
+    def nodes(self):
+        return iter(self.station_ids)
+
+
+# Returns the shortest path from "start" to "finish" in a LazyGraph. It is an A* search where
+# the start is connected to the stations near it, walking, and the rest of the way is estimated by
+# riding straight to the finish, so only the stations on the way are expanded and only their
+# edges are generated. The stations near enough to the start to walk to them are found through
+# the spatial index of the graph.
+# The route may be restricted to start at one of the "origins" and end at one of the
+# "destinations" (data.StationSubsets of the index of G, e.g. the stations with bikes and the
+# ones with docks), and any station is used if they are not given.
+def lazy_path(G, start, finish, origins=None, destinations=None):
+    n = G.number_of_nodes()
+    if n == 0:
+        raise ValueError("The graph has no stations")
+    origins = G.station_index.all() if origins is None else origins
+    destinations = G.station_index.all() if destinations is None else destinations
+    if len(origins) == 0:
+        raise ValueError("There is no station to take a bike from")
+    if len(destinations) == 0:
+        raise ValueError("There is no station to leave the bike at")
+    walk_finish = haversine_array(finish[0], finish[1], G.lat, G.lon) / 4
+    estimate = (walk_finish * 4 / 10).tolist()  # riding is faster than walking
+    is_destination = destinations.mask.tolist()
+
+    # Walking through a single station bounds the cost, so the stations farther from the start
+    # are never reached. The bound is taken from the stations nearest to the start and to the
+    # finish, and only the stations within it are found through the index.
+    best_cost, best_node = float("inf"), -1
+    for k in [origins.near(start[0], start[1]), destinations.near(finish[0], finish[1])]:
+        cost = haversine(start, (G.lat[k], G.lon[k])) / 4 + walk_finish[k]
+        if origins.mask[k] and is_destination[k] and cost < best_cost:
+            best_cost, best_node = cost, k
+
+    first, l = origins.within(start[0], start[1], best_cost * 4)
+    walk_start = l / 4
+    single = destinations.mask[first]
+    if np.any(single):  # the best single station is among them, which tightens the bound
+        k = np.argmin(np.where(single, walk_start + walk_finish[first], np.inf))
+        if walk_start[k] + walk_finish[first[k]] < best_cost:
+            best_cost, best_node = float(walk_start[k] + walk_finish[first[k]]), int(first[k])
+    heap = [(walk + estimate[k], walk, k, -1) for k, walk in zip(first.tolist(), walk_start.tolist())
+            if walk + estimate[k] < best_cost]
+    heapq.heapify(heap)
+
+    previous = dict()
+    while heap:
+        guess, cost, k, prev = heapq.heappop(heap)
+        if guess >= best_cost:
+            break
+        if k in previous:
+            continue
+        previous[k] = prev
+
+        if is_destination[k] and cost + walk_finish[k] < best_cost:
+            best_cost, best_node = cost + walk_finish[k], k
+
+        if G.dist <= 0:
+            continue
+        for j, w in zip(*G.neighbours(k)):
+            c = cost + w
+            if j not in previous and c + estimate[j] < best_cost:
+                heapq.heappush(heap, (c + estimate[j], c, j, k))
+
+    if best_node == -1:
+        raise ValueError("No station with bikes leads to one with docks")
+
+    # Rebuild the path from the last station
+    path = [best_node]
+    while previous.get(path[-1], -1) != -1:
+        path.append(previous[path[-1]])
+    path.reverse()
+
+    return [G.station_ids[k] for k in path]
+
+
+# Connects the given nodes of G to all the nodes closer than distance dist.
+def connect_nodes(G, targets, dist):
+    nodes, lat, lon = station_arrays(G)
+    position = {node: k for k, node in enumerate(nodes)}
+
+    i, j, l = candidate_pairs(lat, lon, dist / 1000, [position[node] for node in targets])
+    add_edges(G, nodes, i, j, l)
+
+
+# Returns the stations that appeared, disappeared and moved from the "old" dataframe to the "new" one.
+def diff_stations(old, new):
+    added = new.index.difference(old.index)
+    removed = old.index.difference(new.index)
+
+    common = new.index.intersection(old.index)
+    moved = ((old.loc[common, "lat"] != new.loc[common, "lat"]) |
+             (old.loc[common, "lon"] != new.loc[common, "lon"]))
+    return added, removed, common[moved.values]
+
+
+# Updates the graph G, built with distance dist on the "old" stations, to the "new" ones.
+# Only the stations that appeared, disappeared or moved are removed, added and connected again.
+def update_graph(G, dist, old, new):
+    added, removed, moved = diff_stations(old, new)
+    G.remove_nodes_from(list(removed) + list(moved))  # together with their edges
+
+    changed = added.union(moved)
+    for st in changed:
+        G.add_node(st, lat=new.at[st, "lat"], lon=new.at[st, "lon"])
+
+    if dist > 0 and len(changed) > 0:
+        connect_nodes(G, changed, dist)
+
+
+# Creates a graph without edges, downloading the stations if they are not given
+def initialize_graph(stations=None):
+    BicingData = get_dataframe() if stations is None else stations
 
     G = nx.Graph()
     for st in BicingData.itertuples():
@@ -370,16 +1341,116 @@ def initialize_graph():
     return G
 
 
-# Constructs a graph according to the given distance or modifies one, when a graph is provided
-def build_graph(dist=1000, G=None, flow=False):
-    if G is None and not flow:
-        G = initialize_graph()
-    elif not flow:
-        clean_graph(G)
+# Constructs a graph according to the given distance or modifies one, when a graph is provided.
+# With legacy=True the edges are computed by the original pair-by-pair method, and with
+# routing=True the distances between all pairs of stations are precomputed for compute_path.
+# When the "previous" stations are given, G must be the graph with the same distance built on
+# them, and it is updated to the new "stations" instead of being built again. When a PairTable
+# of the stations is given, the edges are taken from it if the distance is within its range.
+def build_graph(dist=1000, G=None, flow=False, legacy=False, stations=None, routing=False, previous=None,
+                pairs=None):
+    if previous is not None:
+        update_graph(G, float(dist), previous, stations)
+        G.graph.pop("routing", None)  # it would be outdated
+    elif pairs is not None and not flow and not legacy and float(dist) <= pairs.max_dist:
+        G = initialize_graph(stations)
+        with metrics.timed("bicing_stage_seconds", stage="connect_graph"):
+            pairs.connect(G, float(dist))
+    else:
+        if G is None and not flow:
+            G = initialize_graph(stations)
+        elif not flow:
+            clean_graph(G)
+            G.graph.pop("routing", None)
+
+        # No need to connect if distance is 0
+        if float(dist) > 0:
+            with metrics.timed("bicing_stage_seconds", stage="connect_graph"):
+                connect_graph(G, float(dist), flow, legacy)
+
+    if routing and not flow:
+        with metrics.timed("bicing_stage_seconds", stage="routing_index"):
+            add_routing_index(G)
+
+    return G
 
-    # No need to connect if distance is 0
-    if float(dist) > 0:
-        connect_graph(G, float(dist), flow)
 
+# Returns the arrays that describe the graph G of stations: the stations, their coordinates,
+# the edges and, if G has them, the routing tables. G is built again by graph_from_arrays.
+def graph_arrays(G):
+    nodes, lat, lon = station_arrays(G)
+    position = {node: k for k, node in enumerate(nodes)}
+    edges = list(G.edges(data="weight"))
+    arrays = {"nodes": np.array(nodes), "lat": lat, "lon": lon,
+              "i": np.array([position[u] for u, v, w in edges], dtype=int),
+              "j": np.array([position[v] for u, v, w in edges], dtype=int),
+              "w": np.array([w for u, v, w in edges], dtype=float)}
+    if "routing" in G.graph:
+        arrays["dist"], arrays["pred"] = G.graph["routing"]["dist"], G.graph["routing"]["pred"]
+    return arrays
+
+
+# Returns the graph described by the arrays of graph_arrays.
+def graph_from_arrays(arrays):
+    nodes = arrays["nodes"].tolist()
+    lat, lon = arrays["lat"], arrays["lon"]
+    G = nx.Graph()
+    G.add_nodes_from((node, {"lat": a, "lon": b}) for node, a, b in zip(nodes, lat.tolist(), lon.tolist()))
+    G.add_weighted_edges_from((nodes[i], nodes[j], w) for i, j, w in
+                              zip(arrays["i"].tolist(), arrays["j"].tolist(), arrays["w"].tolist()))
+    if "dist" in arrays:
+        G.graph["routing"] = {"nodes": nodes, "lat": lat, "lon": lon, "dist": arrays["dist"], "pred": arrays["pred"]}
     return G
 
+
+# Returns the bikes and docks of the station with the given id over time, in the history (a
+# history.StatusHistory) between the unix times start and end: a dataframe indexed by time.
+def station_history(status_history, station_id, start=None, end=None):
+    frames = []
+    for block in status_history.blocks(start, end):
+        k = np.flatnonzero(block.stations == station_id)
+        if len(k) == 0:
+            continue
+        bikes, docks = np.array(block.bikes[:, k[0]]), np.array(block.docks[:, k[0]])
+        known = bikes != history.MISSING
+        frames.append(pd.DataFrame({"bikes": bikes[known], "docks": docks[known]},
+                                   index=pd.Index(np.array(block.times)[known], name="time")))
+    if not frames:
+        return pd.DataFrame({"bikes": [], "docks": []}, index=pd.Index([], name="time"), dtype=int)
+    return pd.concat(frames)
+
+
+# Returns the mean, the minimum and the maximum of the bikes and docks of every station in every
+# window of "window" seconds (counted from the unix epoch, or a single one if None) of the
+# history between the unix times start and end, along with the number of samples: a dataframe
+# indexed by the time when the window starts and the station. Every block of the history is
+# reduced at once from its memory-mapped files, so only a day of it is in memory at a time.
+def history_aggregates(status_history, start=None, end=None, window=3600):
+    parts = []
+    blocks = status_history.blocks(start, end)
+    for block in blocks:
+        times = np.array(block.times)
+        windows = times // window * window if window else np.full(len(times), blocks[0].times[0])
+        bounds = np.flatnonzero(np.r_[True, windows[1:] != windows[:-1]])
+        columns = dict()
+        for name, values in [("bikes", block.bikes), ("docks", block.docks)]:
+            known = values != history.MISSING
+            columns[name + "_sum"] = np.add.reduceat(np.where(known, values, 0), bounds, axis=0, dtype=np.int64)
+            columns[name + "_min"] = np.minimum.reduceat(np.where(known, values, np.iinfo(np.int16).max), bounds, axis=0)
+            columns[name + "_max"] = np.maximum.reduceat(values, bounds, axis=0)
+            if name == "bikes":
+                columns["samples"] = np.add.reduceat(known, bounds, axis=0, dtype=np.int64)
+        index = pd.MultiIndex.from_product([windows[bounds], block.stations], names=["time", "station_id"])
+        parts.append(pd.DataFrame({name: values.ravel() for name, values in columns.items()}, index=index))
+
+    if not parts:
+        return pd.DataFrame(columns=["bikes_mean", "bikes_min", "bikes_max", "docks_mean", "docks_min", "docks_max",
+                                     "samples"])
+    # The windows split between blocks (e.g. when the stations change) are joined
+    table = pd.concat(parts).groupby(level=["time", "station_id"]).agg(
+        {"bikes_sum": "sum", "bikes_min": "min", "bikes_max": "max", "docks_sum": "sum", "docks_min": "min",
+         "docks_max": "max", "samples": "sum"})
+    table = table[table["samples"] > 0]
+    table["bikes_mean"] = table.pop("bikes_sum") / table["samples"]
+    table["docks_mean"] = table.pop("docks_sum") / table["samples"]
+    return table[["bikes_mean", "bikes_min", "bikes_max", "docks_mean", "docks_min", "docks_max", "samples"]]
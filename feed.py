@@ -0,0 +1,207 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import requests
+import data as dt
+import metrics
+
+
+# Where the GBFS feeds of Bicing are published.
+URL = 'https://api.bsmsa.eu/ext/api/bsm/gbfs/v2/en/'
+
+
+# One GBFS feed, downloaded again only when its "ttl" has expired and only
+# if the server says it has changed since the previous download. After a failed download it is
+# tried again after min_ttl seconds, twice as long after every other failure, up to max_backoff.
+class Feed:
+
+    def __init__(self, session, url, timeout=10, min_ttl=10, max_backoff=300):
+        self.session = session
+        self.url = url
+        self.timeout = timeout
+        self.min_ttl = min_ttl
+        self.max_backoff = max_backoff
+        self.data = None  # the last downloaded feed, parsed from json
+        self.etag = None
+        self.modified = None
+        self.next_time = 0.0  # when the feed should be downloaded again
+        self.failures = 0  # downloads failed in a row
+
+    # Downloads the feed if it is due. Returns whether its content has changed.
+    def refresh(self):
+        if time.monotonic() < self.next_time:
+            return False
+
+        headers = dict()
+        if self.data is not None:
+            if self.etag is not None:
+                headers['If-None-Match'] = self.etag
+            if self.modified is not None:
+                headers['If-Modified-Since'] = self.modified
+
+        try:
+            response = self.session.get(self.url, headers=headers, timeout=self.timeout)
+            if response.status_code != 304:
+                response.raise_for_status()
+                data = response.json()
+        except Exception:
+            self.failures += 1
+            self.next_time = time.monotonic() + min(self.max_backoff, self.min_ttl * 2 ** (self.failures - 1))
+            raise
+        self.failures = 0
+        if response.status_code == 304:
+            self.next_time = time.monotonic() + self.ttl()
+            return False
+
+        changed = self.data is None or data.get('data') != self.data.get('data')
+        if changed or data.get('ttl') != self.data.get('ttl'):
+            self.data = data  # the same object otherwise, so the users of the data know it has not changed
+        self.etag = response.headers.get('ETag')
+        self.modified = response.headers.get('Last-Modified')
+        self.next_time = time.monotonic() + self.ttl()
+        return changed
+
+    # Returns the number of seconds the feed is valid for, as declared by itself.
+    def ttl(self):
+        return max(self.min_ttl, self.data.get('ttl', 0))
+
+
+# Returns whether both dataframes have the same stations at the same coordinates, so that the
+# graphs built on one of them are also valid for the other.
+def same_places(old, new):
+    return old is new or old[['lat', 'lon']].equals(new[['lat', 'lon']])
+
+
+# Keeps the latest snapshot of the data in memory, downloading the feeds on the background
+# when their ttl expires. Every user reads the same snapshot, so /start and /update do not
+# download anything.
+class FeedPoller:
+
+    def __init__(self, url=URL, timeout=10, min_ttl=10):
+        self.session = requests.Session()
+        self.info = Feed(self.session, url + 'station_information', timeout, min_ttl)
+        self.status = Feed(self.session, url + 'station_status', timeout, min_ttl)
+        self.snapshot = None
+        self.info_data = None  # the data of the feed of the stations of the snapshot
+        self.listeners = []  # functions called with every new snapshot
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    # Downloads the feeds that are due and updates the snapshot if anything changed.
+    # Returns the latest snapshot.
+    def poll(self):
+        with self.lock:
+            try:
+                with metrics.timed("bicing_stage_seconds", stage="feed_poll"):
+                    self.info.refresh()
+                    status_changed = self.status.refresh()
+            except Exception:
+                metrics.count("bicing_feed_errors_total")
+                if self.snapshot is None:
+                    raise ValueError("Could not download the data")
+                return self.snapshot  # the previous one is still valid
+            if self.info.data is None or self.status.data is None:  # waiting to try again after a failure
+                raise ValueError("Could not download the data")
+
+            # The stations are compared with the ones of the snapshot rather than with the previous
+            # download, which may have changed in a poll that failed afterwards.
+            info_changed = self.info.data is not self.info_data
+            if self.snapshot is None or info_changed or status_changed:
+                old = self.snapshot
+                version = 1 if old is None else old.version + 1
+                stations = dt.feed_dataframe(self.info.data) if info_changed or old is None else old.stations
+                if old is not None and same_places(old.stations, stations):
+                    stations_version = old.stations_version  # the graphs are still valid, but not the names
+                else:
+                    stations_version = version
+                bikes = dt.feed_dataframe(self.status.data)
+                self.snapshot = dt.Snapshot(version, stations_version, stations, bikes,
+                                            self.status.data.get('last_updated'))
+                self.info_data = self.info.data
+                metrics.set_gauge("bicing_snapshot_version", version)
+                metrics.set_gauge("bicing_stations", len(stations))
+                for listener in self.listeners:
+                    listener(self.snapshot)
+            return self.snapshot
+
+    # Returns the latest snapshot, downloading it if there is none yet.
+    def get_snapshot(self):
+        if self.snapshot is None:
+            return self.poll()
+        return self.snapshot
+
+    # Keeps polling until stop() is called.
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.poll()
+            except ValueError as e:
+                print(e)
+            wait = min(self.info.next_time, self.status.next_time) - time.monotonic()
+            self.stop_event.wait(max(1.0, wait))
+
+    # Starts polling on a background thread.
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+# Writes the feeds of the given dataframes of stations and bikes in the given directory, in GBFS format.
+def write_feeds(directory, stations, bikes, ttl=30, last_updated=None):
+    if last_updated is None:
+        last_updated = int(time.time())
+    for name, frame in [('station_information', stations), ('station_status', bikes)]:
+        records = frame.reset_index().to_dict('records')
+        feed = {'last_updated': last_updated, 'ttl': ttl, 'data': {'stations': records}}
+        with open(os.path.join(directory, name), 'w') as f:
+            json.dump(feed, f, default=lambda x: x.item())  # numpy numbers
+
+
+# Serves the feeds of a directory, answering "not modified" when the ETag sent matches.
+class FeedHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.hits += 1
+        path = os.path.join(self.server.directory, os.path.basename(self.path))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        with open(path, 'rb') as f:
+            body = f.read()
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# A local server of the feeds written in a directory (see write_feeds), so that the poller
+# can be used without connecting to the real one: FeedPoller(url=server.url).
+class FakeFeedServer(ThreadingHTTPServer):
+
+    def __init__(self, directory, port=0):
+        super().__init__(('127.0.0.1', port), FeedHandler)
+        self.directory = directory
+        self.hits = 0
+        self.url = 'http://127.0.0.1:%d/' % self.server_address[1]
+        threading.Thread(target=self.serve_forever, daemon=True).start()
@@ -0,0 +1,18 @@
+import os
+import threading
+from contextlib import contextmanager
+
+
+# Yields the name of a temporary file where the file at "path" is written, which then replaces
+# it at once, so that no process or thread ever reads a half-written file. The temporary name
+# ends with the given suffix, for the writers that would add it otherwise (e.g. numpy.savez).
+# If writing fails, the temporary file is removed and the old file is left as it was.
+@contextmanager
+def replacing(path, suffix=""):
+    tmp = "%s.%d.%d.tmp%s" % (path, os.getpid(), threading.get_ident(), suffix)
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
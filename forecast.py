@@ -0,0 +1,83 @@
+import threading
+import numpy as np
+import history
+
+
+# The mean bikes of every station in every slot of the week (by default, of half an hour),
+# fitted on the history of their status. The bikes of a station some minutes ahead are forecast
+# as its current ones plus the change of its mean between the slot of now and the one of then,
+# so the forecast keeps what is particular about today and follows the usual trend of the week.
+class SeasonalBaseline:
+
+    def __init__(self, slot=1800, period=7 * 24 * 3600):
+        self.slot = slot
+        self.n_slots = period // slot
+        self.columns = dict()  # station id -> its column in the arrays
+        self.sums = np.zeros((self.n_slots, 0))
+        self.counts = np.zeros((self.n_slots, 0), dtype=np.int64)
+        self.last_time = None  # the time of the last row of the history fitted
+        self.lock = threading.Lock()
+
+    # Returns the slots of the week of the given unix times, which may have fractions of a second.
+    def slots(self, times):
+        return (np.asarray(times).astype(np.int64) // self.slot) % self.n_slots
+
+    # Returns the columns of the given stations, adding the ones not seen yet.
+    def station_columns(self, stations):
+        new = [station for station in stations if station not in self.columns]
+        if new:
+            for station in new:
+                self.columns[station] = len(self.columns)
+            self.sums = np.hstack((self.sums, np.zeros((self.n_slots, len(new)))))
+            self.counts = np.hstack((self.counts, np.zeros((self.n_slots, len(new)), dtype=np.int64)))
+        return np.array([self.columns[station] for station in stations], dtype=int)
+
+    # Adds the rows of the history (a history.StatusHistory) that are newer than the ones already
+    # fitted, so it can be called on every poll. Every block is reduced at once: its rows are in
+    # order of time, so those of the same slot come together.
+    def update(self, status_history):
+        with self.lock:
+            start = None if self.last_time is None else self.last_time + 1
+            for block in status_history.blocks(start):
+                times = np.array(block.times)
+                slots = self.slots(times)
+                bounds = np.flatnonzero(np.r_[True, slots[1:] != slots[:-1]])
+                known = block.bikes != history.MISSING
+                sums = np.add.reduceat(np.where(known, block.bikes, 0), bounds, axis=0, dtype=np.float64)
+                counts = np.add.reduceat(known, bounds, axis=0, dtype=np.int64)
+
+                columns = self.station_columns(block.stations.tolist())
+                rows = slots[bounds]
+                np.add.at(self.sums, (rows[:, None], columns[None, :]), sums)
+                np.add.at(self.counts, (rows[:, None], columns[None, :]), counts)
+                self.last_time = int(times[-1])
+
+    # Returns the mean bikes of the given stations in the slot of the given time (NaN if unknown).
+    def means(self, stations, t):
+        slot = self.slots(t)
+        known = np.array([station in self.columns for station in stations])
+        columns = np.array([self.columns.get(station, 0) for station in stations], dtype=int)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = self.sums[slot, columns] / self.counts[slot, columns]
+        means[~known] = np.nan
+        return means
+
+    # Returns the forecast of the bikes (a dataframe like the bikes of a snapshot) "minutes"
+    # minutes after the unix time t. The bikes and docks of every station add up to the same
+    # as now, and the stations without history keep their current bikes.
+    def predict(self, bikes, t, minutes):
+        stations = bikes.index.tolist()
+        with self.lock:
+            change = self.means(stations, t + minutes * 60) - self.means(stations, t)
+        change[np.isnan(change)] = 0
+
+        now = bikes["num_bikes_available"].to_numpy()
+        total = now + bikes["num_docks_available"].to_numpy()
+        forecast = bikes.copy()
+        forecast["num_bikes_available"] = np.clip(np.rint(now + change), 0, total).astype(now.dtype)
+        forecast["num_docks_available"] = total - forecast["num_bikes_available"].to_numpy()
+        return forecast
+
+    # Returns the number of stations with some history and of samples fitted.
+    def size(self):
+        return len(self.columns), int(self.counts.sum())
@@ -0,0 +1,130 @@
+import time
+import sqlite3
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+
+# The answer of a geocoder, with the same attributes as the locations of geopy.
+Location = namedtuple('Location', ['latitude', 'longitude'])
+
+
+# Returns the key under which an address is cached: lowercase and with single spaces.
+def normalize(address):
+    return " ".join(address.lower().split())
+
+
+# Lets the calls go through at most once every "interval" seconds.
+# Instead of failing, the calls that come too early wait for their turn.
+class RateLimiter:
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    # Blocks until the caller is allowed to go through.
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            turn = max(now, self.next_time)
+            self.next_time = turn + self.interval
+        time.sleep(turn - now)
+
+
+# A geocoder that knows only the addresses it is given, so everything can be used offline.
+# The city appended to the queries is ignored.
+class StubGeocoder:
+
+    def __init__(self, places):
+        self.places = {normalize(address): coords for address, coords in places.items()}
+        self.calls = 0
+
+    def geocode(self, query):
+        self.calls += 1
+        coords = self.places.get(normalize(query.split(',')[0]))
+        return None if coords is None else Location(*coords)
+
+
+# Finds the coordinates of addresses of a city, remembering them in memory (the most recently
+# used ones) and on disk (for "ttl" seconds), and calling the geocoding service at the
+# rate it allows. Nominatim is used unless another client with a "geocode" method is given.
+class Geocoder:
+
+    def __init__(self, client=None, path="geocoding.sqlite", city="Barcelona",
+                 ttl=30 * 24 * 3600, memory_size=1024, interval=1.0):
+        self.client = client
+        self.city = city
+        self.ttl = ttl
+        self.memory_size = memory_size
+        self.memory = OrderedDict()  # key -> (lat, lon), from least to most recently used
+        self.limiter = RateLimiter(interval)
+        self.lock = threading.Lock()
+
+        # Without a path the addresses are only cached in memory
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('''CREATE TABLE IF NOT EXISTS places
+                               (address TEXT PRIMARY KEY, lat REAL, lon REAL, time REAL)''')
+            self.db.commit()
+
+    # Returns the client of the geocoding service, creating it the first time.
+    def get_client(self):
+        if self.client is None:
+            import geopy as geo  # only imported by the processes that geocode
+            self.client = geo.Nominatim(user_agent="bicing_bot")
+        return self.client
+
+    # Remembers the coordinates of the address with the given key in memory.
+    def remember(self, key, coords):
+        with self.lock:
+            self.memory[key] = coords
+            self.memory.move_to_end(key)
+            if len(self.memory) > self.memory_size:
+                self.memory.popitem(last=False)
+
+    # Returns the coordinates of the address with the given key saved on disk, or None.
+    def read_disk(self, key):
+        if self.db is None:
+            return None
+        with self.lock:
+            row = self.db.execute("SELECT lat, lon, time FROM places WHERE address = ?", (key,)).fetchone()
+        if row is None or time.time() - row[2] > self.ttl:
+            return None
+        return row[0], row[1]
+
+    # Saves the coordinates of the address with the given key on disk.
+    def write_disk(self, key, coords):
+        if self.db is None:
+            return
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO places VALUES (?, ?, ?, ?)", (key, coords[0], coords[1], time.time()))
+            self.db.commit()
+
+    # Returns the coordinates (lat, lon) of the given address.
+    def locate(self, address):
+        key = normalize(address)
+        with self.lock:
+            coords = self.memory.get(key)
+        result = "memory"
+        if coords is None:
+            coords, result = self.read_disk(key), "disk"
+            if coords is None:
+                result = "miss"
+                self.limiter.wait()
+                location = self.get_client().geocode(address.strip() + ', ' + self.city)
+                if location is None:
+                    raise ValueError("Address not found")
+                coords = (location.latitude, location.longitude)
+                self.write_disk(key, coords)
+
+        metrics.count("bicing_cache_requests_total", cache="geocoding", result=result)
+        self.remember(key, coords)
+        return coords
+
+    # Returns the coordinates of all the given addresses, looked for at the same time.
+    def locate_all(self, addresses):
+        with ThreadPoolExecutor(max_workers=len(addresses)) as pool:
+            return list(pool.map(self.locate, addresses))
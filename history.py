@@ -0,0 +1,156 @@
+import os
+import re
+import time
+import threading
+from collections import namedtuple
+import numpy as np
+
+
+# The columns of the status of the stations that are kept, and the name of their files.
+COLUMNS = {"bikes": "num_bikes_available", "docks": "num_docks_available"}
+
+# The value kept for the stations missing from a status.
+MISSING = -1
+
+# The rows of a block of the history (see StatusHistory.blocks): the times, the ids of the
+# stations (the columns) and the bikes and docks of every station at every time.
+Block = namedtuple('Block', ['times', 'stations', 'bikes', 'docks'])
+
+
+# Returns the name of the day (in UTC) of the given unix time, e.g. "20240131".
+def day_name(t):
+    return time.strftime("%Y%m%d", time.gmtime(t))
+
+
+# The history of the status of the stations: the bikes and docks of every station each time the
+# status changes, kept in the given directory for "days" days.
+# The history is split in blocks, one per day unless the stations change during it. Every block
+# is a file with the ids of its stations and a file per column (the times, the bikes and the
+# docks) where the rows are appended as raw int64 or int16 values, so a row only costs 8 bytes
+# plus 4 per station and the files are read through memory mapping without loading them. A row
+# is only appended if the time of the status (the "last_updated" of the feed) is later than
+# the previous one.
+class StatusHistory:
+
+    def __init__(self, directory="history", days=30):
+        self.directory = directory
+        self.days = days
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.block = None  # the name of the block where the rows are appended
+        self.stations = None  # its stations, and their positions
+        self.positions = None
+        self.index = None  # the last index of the status appended, and the columns of its stations
+        self.columns = None
+        self.files = None
+        self.last_time = None
+
+        names = self.block_names()
+        if names:
+            times = self.read(names[-1]).times
+            if len(times):
+                self.last_time = int(times[-1])
+
+    # Returns the path of the file of the given block with the given column.
+    def path(self, block, column):
+        return os.path.join(self.directory, "%s.%s" % (block, column))
+
+    # Returns the names of the blocks, from the oldest to the newest.
+    def block_names(self):
+        names = [name[:-len(".stations.npy")] for name in os.listdir(self.directory) if name.endswith(".stations.npy")]
+        return sorted(names, key=lambda name: tuple(int(part) for part in name.split("_")))
+
+    # Returns the rows of the given block, memory-mapped. A row half-written when the process was
+    # stopped is ignored.
+    def read(self, block):
+        stations = np.load(self.path(block, "stations.npy"))
+        columns = dict()
+        for column, dtype in [("times", np.int64), ("bikes", np.int16), ("docks", np.int16)]:
+            path = self.path(block, column)
+            if os.path.getsize(path) == 0:
+                columns[column] = np.zeros(0, dtype=dtype)
+            else:
+                columns[column] = np.memmap(path, dtype=dtype, mode="r")
+        n = min(len(columns["times"]), len(columns["bikes"]) // len(stations), len(columns["docks"]) // len(stations))
+        return Block(columns["times"][:n], stations, columns["bikes"][:n * len(stations)].reshape(n, len(stations)),
+                     columns["docks"][:n * len(stations)].reshape(n, len(stations)))
+
+    # Starts a new block for the given stations on the day of the given time.
+    def start_block(self, t, stations):
+        self.close()
+        day = day_name(t)
+        numbers = [int(name.split("_")[1]) for name in self.block_names() if name.split("_")[0] == day]
+        self.block = "%s_%d" % (day, max(numbers, default=-1) + 1)
+        self.stations = stations
+        self.positions = {station: k for k, station in enumerate(stations)}
+        self.files = {column: open(self.path(self.block, column), "ab") for column in ("times", "bikes", "docks")}
+        np.save(self.path(self.block, "stations.npy"), stations)  # last, as it is what makes the block seen
+        self.prune(t)
+
+    # Appends the status of the stations (a dataframe like the bikes of a snapshot) at the given
+    # unix time. Returns whether it was appended, which it is not if it is not newer than the last one.
+    def append(self, t, status):
+        t = int(t)
+        with self.lock:
+            if self.last_time is not None and t <= self.last_time:
+                return False
+
+            new_day = self.block is None or day_name(t) != self.block.split("_")[0]
+            if new_day or not status.index.equals(self.index):
+                stations = np.asarray(status.index)
+                if stations.dtype == object:
+                    stations = stations.astype(str)
+                if new_day or any(station not in self.positions for station in stations):
+                    self.start_block(t, stations)
+                self.index = status.index
+                self.columns = np.array([self.positions[station] for station in stations], dtype=int)
+
+            rows = {"times": np.array([t], dtype=np.int64)}
+            for column, name in COLUMNS.items():
+                row = np.full(len(self.stations), MISSING, dtype=np.int16)
+                row[self.columns] = status[name].fillna(MISSING).to_numpy()
+                rows[column] = row
+            for column, row in rows.items():
+                self.files[column].write(row.tobytes())
+                self.files[column].flush()
+            self.last_time = t
+            return True
+
+    # Appends the status of the snapshot, at the time it was updated (or else now).
+    def append_snapshot(self, snap):
+        t = snap.last_updated if snap.last_updated is not None else time.time()
+        return self.append(t, snap.bikes)
+
+    # Returns the blocks with some rows between the unix times start and end (both included if
+    # given), memory-mapped and restricted to those rows.
+    def blocks(self, start=None, end=None):
+        found = []
+        for name in self.block_names():
+            day = name.split("_")[0]
+            if (start is not None and day < day_name(start)) or (end is not None and day > day_name(end)):
+                continue
+            block = self.read(name)
+            first = 0 if start is None else np.searchsorted(block.times, start, side="left")
+            last = len(block.times) if end is None else np.searchsorted(block.times, end, side="right")
+            if first < last:
+                found.append(Block(block.times[first:last], block.stations, block.bikes[first:last],
+                                   block.docks[first:last]))
+        return found
+
+    # Deletes the blocks of the days older than the ones kept at the given time.
+    def prune(self, t):
+        oldest = day_name(t - self.days * 24 * 3600)
+        for name in os.listdir(self.directory):
+            match = re.match(r"(\d{8})_\d+\.", name)
+            if match and match.group(1) < oldest:
+                os.remove(os.path.join(self.directory, name))
+
+    # Returns the number of bytes of all the files of the history.
+    def nbytes(self):
+        return sum(os.path.getsize(os.path.join(self.directory, name)) for name in os.listdir(self.directory))
+
+    def close(self):
+        if self.files is not None:
+            for f in self.files.values():
+                f.close()
+            self.files = None
@@ -0,0 +1,297 @@
+# Load test of the bot: drives its dispatcher with fake updates on synthetic data, without
+# connecting to Telegram, and compares the latency of a cheap command (/nodes) when the bot
+# is idle, when heavy commands (/graph, /distribute) are being attended at the same time and
+# when a user sends many commands at once.
+# With "cluster", the updates are posted to the webhook of the bot run as several processes
+# (see cluster.py) instead, and its throughput and the memory of the workers are measured for
+# every number of processes.
+# Usage: python loadtest.py
+#        python loadtest.py cluster [--processes 1 2 4]
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import tempfile
+import functools
+import threading
+import multiprocessing
+import urllib.request
+from queue import Queue
+import numpy as np
+import telegram
+from telegram.ext import Dispatcher
+import data as dt
+import bot
+import feed
+import cluster
+import metrics
+import benchmark
+
+
+# A bot that records when it answers every chat instead of sending the messages.
+class FakeBot:
+    username = "bicing_bot"
+
+    def __init__(self):
+        self.answers = dict()  # chat id -> queue with the times of the answers
+        self.lock = threading.Lock()
+
+    def answered(self, chat_id):
+        with self.lock:
+            return self.answers.setdefault(chat_id, Queue())
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.answered(chat_id).put(time.perf_counter())
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        self.answered(chat_id).put(time.perf_counter())
+
+
+# Returns an update with the given command, sent by the given user on a private chat.
+def fake_update(fake_bot, usr_id, text, update_id):
+    user = telegram.User(usr_id, "user" + str(usr_id), False)
+    chat = telegram.Chat(usr_id, "private")
+    message = telegram.Message(update_id, user, datetime.datetime.now(), chat, text=text, bot=fake_bot)
+    return telegram.Update(update_id, message=message)
+
+
+# Sends the command as the given user and returns the time (in ms) until it is answered.
+def send(dispatcher, usr_id, text):
+    send.count += 1
+    t = time.perf_counter()
+    dispatcher.update_queue.put(fake_update(dispatcher.bot, usr_id, text, send.count))
+    return (dispatcher.bot.answered(usr_id).get() - t) * 1000
+
+
+send.count = 0
+
+
+# Sends "n" cheap commands from random users and returns their latencies.
+def cheap_load(dispatcher, users, n, pause=0.02):
+    latencies = []
+    for _ in range(n):
+        latencies.append(send(dispatcher, random.choice(users), "/nodes"))
+        time.sleep(pause)
+    return latencies
+
+
+# Keeps sending heavy commands as the given user until "stop" is set.
+def heavy_load(dispatcher, usr_id, stop, pause=0.02):
+    commands = ["/graph 5000", "/distribute 2 2", "/graph 3000", "/distribute 5 5", "/graph 1000"]
+    k = 0
+    while not stop.is_set():
+        send(dispatcher, usr_id, commands[k % len(commands)])
+        k += 1
+        time.sleep(pause)
+
+
+# Sends the command n times at once as the given user, without waiting for the answers, like a
+# user who taps it again and again. Returns a function that waits for all the answers.
+def burst(dispatcher, usr_id, text, n):
+    for _ in range(n):
+        send.count += 1
+        dispatcher.update_queue.put(fake_update(dispatcher.bot, usr_id, text, send.count))
+    return lambda: [dispatcher.bot.answered(usr_id).get() for _ in range(n)]
+
+
+# Prints the median and the 99th percentile of the given latencies.
+def summary(name, latencies):
+    print("%-22s p50 %8.2f ms   p99 %8.2f ms" % (name, np.percentile(latencies, 50), np.percentile(latencies, 99)))
+
+
+def run_single(n_cheap=200, n_heavy=4, n_burst=10):
+    stations = benchmark.synthetic_stations()
+    bot.poller = feed.FeedPoller()
+    bot.poller.snapshot = dt.Snapshot(1, 1, stations, benchmark.synthetic_bikes(stations))
+
+    dispatcher = Dispatcher(FakeBot(), Queue(), workers=bot.WORKERS)
+    bot.add_handlers(dispatcher)
+    ready = threading.Event()
+    threading.Thread(target=dispatcher.start, args=(ready,)).start()
+    ready.wait()
+
+    cheap_users = list(range(1, 11))
+    heavy_users = list(range(100, 100 + n_heavy))
+    for usr_id in cheap_users + heavy_users:
+        send(dispatcher, usr_id, "/start")
+    while len(bot.dict_graphs) < len(cheap_users) + len(heavy_users):
+        time.sleep(0.01)
+
+    summary("/nodes, idle", cheap_load(dispatcher, cheap_users, n_cheap))
+
+    stop = threading.Event()
+    threads = [threading.Thread(target=heavy_load, args=(dispatcher, usr_id, stop)) for usr_id in heavy_users]
+    for thread in threads:
+        thread.start()
+    summary("/nodes, heavy load", cheap_load(dispatcher, cheap_users, n_cheap))
+
+    stop.set()
+    for thread in threads:
+        thread.join()
+    # The heavy commands beyond bot.MAX_QUEUED_HEAVY waiting are turned down instead of taking threads
+    print("heavy commands turned down:", sum(value for (name, labels), value in metrics.registry.counters.items()
+                                             if name == "bicing_heavy_rejected_total"))
+
+    # The commands of a user are attended one at a time, which must not keep the others waiting
+    wait = burst(dispatcher, heavy_users[0], "/distribute 1 1", n_burst)
+    summary("/nodes, burst", cheap_load(dispatcher, cheap_users, n_cheap))
+    wait()
+    dispatcher.stop()
+    if bot.heavy_pool is not None:
+        bot.heavy_pool.shutdown()
+
+
+# A bot that sends the time when it answers every chat, and whether the command was turned down
+# because the bot was busy, to the queue of the load test, from the worker process where it runs.
+class ReportingBot:
+    username = "bicing_bot"
+
+    def __init__(self, answers):
+        self.answers = answers
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.answers.put((chat_id, time.monotonic(), bot.BUSY in str(text)))
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        self.answers.put((chat_id, time.monotonic(), False))
+
+
+# Returns an update with the given command as Telegram sends it to a webhook.
+def update_json(usr_id, text, update_id):
+    user = {"id": usr_id, "is_bot": False, "first_name": "user" + str(usr_id)}
+    message = {"message_id": update_id, "from": user, "chat": {"id": usr_id, "type": "private"},
+               "date": int(time.time()), "text": text}
+    return json.dumps({"update_id": update_id, "message": message}).encode()
+
+
+# A fake source of updates: posts them to the webhook of the cluster as Telegram would, and
+# waits for the answers that the workers send back through the queue "answers".
+class UpdateSource:
+
+    def __init__(self, url, answers):
+        self.url = url
+        self.count = 0
+        self.lock = threading.Lock()
+        self.chats = dict()  # chat id -> queue with the times of the answers and whether they were busy
+        threading.Thread(target=self.collect, args=(answers,), daemon=True).start()
+
+    def answered(self, chat_id):
+        with self.lock:
+            return self.chats.setdefault(chat_id, Queue())
+
+    def collect(self, answers):
+        while True:
+            chat_id, t, busy = answers.get()
+            self.answered(chat_id).put((t, busy))
+
+    # Sends the command as the given user, again after a pause every time it is turned down
+    # because the bot is busy (see bot.run_heavy), like a user would. Returns the time (in ms)
+    # from the first time it is sent until it is answered, and the times it was turned down.
+    def send(self, usr_id, text, pause=1):
+        t = time.monotonic()
+        turned_down = 0
+        while True:
+            with self.lock:
+                self.count += 1
+                update_id = self.count
+            request = urllib.request.Request(self.url, data=update_json(usr_id, text, update_id),
+                                             headers={"Content-Type": "application/json"})
+            urllib.request.urlopen(request).close()
+            answered, busy = self.answered(usr_id).get()
+            if not busy:
+                return (answered - t) * 1000, turned_down
+            turned_down += 1
+            time.sleep(pause)
+
+
+# The commands every user of the cluster load test sends in a round, after /graph with its distance.
+CLUSTER_COMMANDS = ["/nodes", "/edges", "/components", "/distribute 2 2", "/plotgraph"]
+
+
+# Sends "rounds" rounds of commands as the given user, appending their latencies and the times
+# they were turned down (see UpdateSource.send) to the list.
+def user_load(source, usr_id, rounds, results):
+    for k in range(rounds):
+        results.append(source.send(usr_id, "/graph %d" % (500 + 100 * ((usr_id + k) % 16))))
+        for command in CLUSTER_COMMANDS:
+            results.append(source.send(usr_id, command))
+
+
+# Returns the resident set size of the process with the given pid and its proportional set size
+# (where the pages shared with other processes, e.g. the memory-mapped graphs, are divided among
+# them), in MB, read from /proc. Returns None if they are not available there.
+def process_memory(pid):
+    try:
+        with open("/proc/%d/smaps_rollup" % pid) as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return None
+    return int(fields["Rss"].split()[0]) / 1024, int(fields["Pss"].split()[0]) / 1024
+
+
+# Runs the bot as n_processes workers on synthetic feeds of n_stations and the given number of
+# users sending commands at the same time. Prints the throughput and the latencies of the commands.
+def run_cluster(n_processes, n_users=32, rounds=3, n_stations=1000):
+    with tempfile.TemporaryDirectory() as directory:
+        feeds = os.path.join(directory, "feeds")
+        os.makedirs(feeds)
+        benchmark.synthetic_feeds(feeds, n_stations)
+        server = feed.FakeFeedServer(feeds)
+        os.environ["BICING_OFFLINE_TILES"] = "1"  # inherited by the workers
+
+        answers = multiprocessing.get_context("spawn").Queue()
+        argv = ["--token", "fake", "--state-dir", os.path.join(directory, "state"), "--feed-url", server.url]
+        queues, processes = cluster.start_workers(n_processes, argv, functools.partial(ReportingBot, answers))
+        front = cluster.WebhookServer(queues, host="127.0.0.1", port=0)
+        threading.Thread(target=front.serve_forever, daemon=True).start()
+        source = UpdateSource(front.url, answers)
+
+        users = list(range(1, n_users + 1))
+        for usr_id in users:  # also waits for the workers to start
+            source.send(usr_id, "/start")
+
+        results = []
+        threads = [threading.Thread(target=user_load, args=(source, usr_id, rounds, results)) for usr_id in users]
+        t = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - t
+        memory = [process_memory(process.pid) for process in processes]
+
+        latencies, turned_down = zip(*results)
+        print("%d processes: %6.1f commands/s" % (n_processes, len(latencies) / elapsed), end="   ")
+        summary("latency", latencies)
+        print("             turned down and sent again: %d" % sum(turned_down))
+        if None not in memory:
+            print("             memory per worker: RSS %.0f MB, PSS %.0f MB" % tuple(np.mean(memory, axis=0)))
+        front.shutdown()
+        cluster.stop_workers(queues, processes)
+        server.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test of the bot with fake updates.")
+    commands = parser.add_subparsers(dest="command")
+    scaling = commands.add_parser("cluster", help="measure the throughput of the bot run as several processes")
+    scaling.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    scaling.add_argument("--users", type=int, default=32)
+    scaling.add_argument("--rounds", type=int, default=3)
+    scaling.add_argument("--stations", type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    if args.command == "cluster":
+        print("CPUs:", os.cpu_count())
+        for n in args.processes:
+            run_cluster(n, args.users, args.rounds, args.stations)
+    else:
+        run_single()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
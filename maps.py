@@ -0,0 +1,49 @@
+import os
+import hashlib
+from io import BytesIO
+from PIL import Image
+from staticmap import StaticMap
+import files
+import metrics
+
+
+# The maps drawn by render.new_map, kept apart so that staticmap (and requests, which it imports)
+# are only imported by the processes that draw.
+
+
+# A map that keeps the downloaded tiles in the given directory, so they are only requested once.
+class CachedMap(StaticMap):
+
+    def __init__(self, width, height, tile_dir, **kwargs):
+        super().__init__(width, height, **kwargs)
+        self.tile_dir = tile_dir
+
+    # Returns the status code and the content of the tile with the given url.
+    def get(self, url, **kwargs):
+        path = os.path.join(self.tile_dir, hashlib.sha1(url.encode()).hexdigest() + ".png")
+        if os.path.isfile(path):
+            metrics.count("bicing_cache_requests_total", cache="tile", result="hit")
+            with open(path, "rb") as f:
+                return 200, f.read()
+        metrics.count("bicing_cache_requests_total", cache="tile", result="miss")
+
+        status, content = super().get(url, **kwargs)
+        if status == 200:
+            os.makedirs(self.tile_dir, exist_ok=True)
+            with files.replacing(path) as tmp, open(tmp, "wb") as f:
+                f.write(content)
+        return status, content
+
+
+# Returns the content of a plain tile of the given size, as a PNG file.
+def plain_tile(size=256):
+    buffer = BytesIO()
+    Image.new("RGB", (size, size), "#e8e4d8").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+# A map drawn on plain tiles, without connecting to any tile server.
+class OfflineMap(StaticMap):
+
+    def get(self, url, **kwargs):
+        return 200, plain_tile(self.tile_size)
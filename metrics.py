@@ -0,0 +1,264 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import files
+
+
+# With BICING_METRICS=0 nothing is measured, and every function of this module returns at once.
+ENABLED = os.environ.get("BICING_METRICS", "1") != "0"
+
+# The upper bounds of the buckets of the histograms of times (in seconds) and sizes (in bytes).
+SECONDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BYTES = tuple(2 ** k for k in range(10, 31, 2))
+
+
+# How many values fell in every bucket, along with their sum.
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is for the values above all the bounds
+        self.sum = 0.0
+
+    def observe(self, value):
+        k = 0
+        while k < len(self.buckets) and value > self.buckets[k]:
+            k += 1
+        self.counts[k] += 1
+        self.sum += value
+
+    def count(self):
+        return sum(self.counts)
+
+    # Returns the upper bound of the bucket where the given fraction of the values is reached.
+    def quantile(self, q):
+        target, seen = q * self.count(), 0
+        for bound, n in zip(self.buckets + (float("inf"),), self.counts):
+            seen += n
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+
+
+# The counters, gauges and histograms recorded, indexed by (name, labels), where the labels are
+# a sorted tuple of (label, value) pairs.
+class Registry:
+
+    def __init__(self):
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+        self.lock = threading.Lock()
+
+    def count(self, key, value):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, key, value):
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, key, value, buckets):
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    # Adds what was recorded in another registry (e.g. in another process) to this one.
+    def merge(self, other):
+        with self.lock:
+            for key, value in other.counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            self.gauges.update(other.gauges)
+            for key, histogram in other.histograms.items():
+                if key in self.histograms:
+                    self.histograms[key].merge(histogram)
+                else:
+                    self.histograms[key] = histogram
+
+    def __getstate__(self):  # the lock can not be sent to another process
+        with self.lock:
+            return {"counters": dict(self.counters), "gauges": dict(self.gauges), "histograms": dict(self.histograms)}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+registry = Registry()
+
+
+def metric_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+# Adds value to the counter with the given name and labels.
+def count(name, value=1, **labels):
+    if ENABLED:
+        registry.count(metric_key(name, labels), value)
+
+
+# Sets the gauge with the given name and labels to value.
+def set_gauge(name, value, **labels):
+    if ENABLED:
+        registry.set_gauge(metric_key(name, labels), value)
+
+
+# Adds value to the histogram with the given name and labels.
+def observe(name, value, buckets=SECONDS, **labels):
+    if ENABLED:
+        registry.observe(metric_key(name, labels), value, buckets)
+
+
+@contextmanager
+def timer(name, labels):
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(metric_key(name, labels), time.perf_counter() - t, SECONDS)
+
+
+# Does nothing, for the blocks timed while the metrics are disabled.
+class Nothing:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NOTHING = Nothing()
+
+
+# Returns a context that adds the time (in seconds) its block takes to the given histogram:
+#     with metrics.timed("bicing_stage_seconds", stage="render"):
+def timed(name, **labels):
+    if ENABLED:
+        return timer(name, labels)
+    return NOTHING
+
+
+# Returns the result of func(*args, **kwargs) and what it recorded, to be merged into the
+# registry of another process (see merge).
+def collect(func, *args, **kwargs):
+    global registry
+    previous, registry = registry, Registry()
+    try:
+        return func(*args, **kwargs), registry
+    finally:
+        registry = previous
+
+
+# Adds the metrics recorded by collect in another process.
+def merge(recorded):
+    if ENABLED:
+        registry.merge(recorded)
+
+
+def text_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (label, str(value).replace('"', '\\"')) for label, value in labels) + "}"
+
+
+# Returns all the metrics in the text format of Prometheus.
+def export():
+    with registry.lock:
+        counters, gauges = sorted(registry.counters.items()), sorted(registry.gauges.items())
+        histograms = sorted((k, (h.buckets, list(h.counts), h.sum)) for k, h in registry.histograms.items())
+
+    lines = []
+    for kind, items in [("counter", counters), ("gauge", gauges)]:
+        for name in sorted(set(name for (name, labels), value in items)):
+            lines.append("# TYPE %s %s" % (name, kind))
+            lines += ["%s%s %s" % (name, text_labels(labels), value) for (n, labels), value in items if n == name]
+    for name in sorted(set(name for (name, labels), value in histograms)):
+        lines.append("# TYPE %s histogram" % name)
+        for (n, labels), (buckets, counts, total) in histograms:
+            if n != name:
+                continue
+            seen = 0
+            for bound, k in zip(buckets + ("+Inf",), counts):
+                seen += k
+                lines.append("%s_bucket%s %d" % (name, text_labels(labels, [("le", bound)]), seen))
+            lines.append("%s_sum%s %s" % (name, text_labels(labels), total))
+            lines.append("%s_count%s %d" % (name, text_labels(labels), seen))
+    return "\n".join(lines) + "\n"
+
+
+# Writes the metrics to the given file, replacing it at once.
+def write(path):
+    with files.replacing(path) as tmp, open(tmp, "w") as f:
+        f.write(export())
+
+
+# Writes the metrics to the given file every "interval" seconds, on a background thread.
+def write_every(path, interval=15):
+    def run():
+        while True:
+            write(path)
+            time.sleep(interval)
+    threading.Thread(target=run, daemon=True).start()
+
+
+# Serves the metrics at /metrics, for Prometheus to scrape them.
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = export().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Starts serving the metrics on the given port, on a background thread. Returns the server.
+def serve(port, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Returns a short summary of the metrics, for the /stats command: the calls, the median and 95th
+# percentile (the upper bound of their buckets) of every histogram, and the counters and gauges.
+def summary():
+    if not ENABLED:
+        return "Metrics are disabled"
+    with registry.lock:
+        counters, gauges = sorted(registry.counters.items()), sorted(registry.gauges.items())
+        histograms = sorted(registry.histograms.items())
+
+    lines = []
+    for (name, labels), h in histograms:
+        label = ",".join(str(v) for l, v in labels)
+        if h.buckets == SECONDS:
+            lines.append("%s %s: %d, mean %.0f ms, p50 < %s ms, p95 < %s ms" % (
+                name.replace("bicing_", "").replace("_seconds", ""), label, h.count(),
+                h.sum / max(h.count(), 1) * 1000, bound_ms(h.quantile(0.5)), bound_ms(h.quantile(0.95))))
+        else:
+            lines.append("%s %s: %d, mean %.0f KB" % (name.replace("bicing_", ""), label, h.count(),
+                                                     h.sum / max(h.count(), 1) / 1024))
+    for (name, labels), value in counters + gauges:
+        label = ",".join(str(v) for l, v in labels)
+        lines.append("%s %s: %s" % (name.replace("bicing_", ""), label, value))
+    return "\n".join(lines) if lines else "Nothing measured yet"
+
+
+def bound_ms(bound):
+    return "inf" if bound == float("inf") else "%g" % (bound * 1000)
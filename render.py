@@ -0,0 +1,95 @@
+import os
+import hashlib
+import threading
+from io import BytesIO
+from collections import OrderedDict
+import metrics
+
+
+# Where the map tiles are kept once downloaded.
+TILE_DIR = os.environ.get("BICING_TILE_DIR", "tiles")
+
+# With BICING_OFFLINE_TILES=1 the maps are drawn on plain tiles instead of downloaded ones.
+OFFLINE = os.environ.get("BICING_OFFLINE_TILES") == "1"
+
+
+# Returns a new map of the given size, where the lines and markers are added. The maps are
+# imported the first time one is drawn (see maps.py).
+def new_map(width, height):
+    import maps
+    if OFFLINE:
+        return maps.OfflineMap(width, height)
+    return maps.CachedMap(width, height, TILE_DIR)
+
+
+# Returns the image as a PNG file in memory.
+def to_png(image):
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    buffer.seek(0)
+    return buffer
+
+
+# Returns a key for the content described by the given values.
+def content_key(*values):
+    return hashlib.sha1(repr(values).encode()).hexdigest()
+
+
+# The most recently rendered images (their PNG files), up to "max_bytes" in total.
+class ImageCache:
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()  # key -> content of the file, from least to most recently used
+        self.size = 0
+        self.lock = threading.Lock()
+
+    # Returns the image with the given key as a new file in memory, or None if it is not cached.
+    def get(self, key):
+        with self.lock:
+            if key not in self.images:
+                metrics.count("bicing_cache_requests_total", cache="image", result="miss")
+                return None
+            metrics.count("bicing_cache_requests_total", cache="image", result="hit")
+            self.images.move_to_end(key)
+            return BytesIO(self.images[key])
+
+    # Keeps the image (a file in memory) with the given key.
+    def put(self, key, image):
+        content = image.getvalue()
+        with self.lock:
+            if key in self.images:
+                return
+            self.images[key] = content
+            self.size += len(content)
+            while self.size > self.max_bytes and len(self.images) > 1:
+                self.size -= len(self.images.popitem(last=False)[1])
+            metrics.set_gauge("bicing_cache_bytes", self.size, cache="image")
+
+
+# Returns a chart of the table of data.distribute_sweep as a PNG file in memory: a grid with a
+# row for every demand and a column for every distance, from green (cheap) to red (expensive),
+# and grey where the distribution is not possible.
+def draw_sweep(table, cell=48):
+    from PIL import Image, ImageDraw  # only imported by the processes that draw charts
+    left, top = 80, 24
+    rows, cols = table.shape
+    image = Image.new("RGB", (left + cols * cell, top + rows * cell), "white")
+    draw = ImageDraw.Draw(image)
+
+    costs = table.to_numpy()
+    highest = max(costs[costs == costs].max(), 1e-9) if (costs == costs).any() else 1
+    for c, dist in enumerate(table.columns):
+        draw.text((left + c * cell + 4, 6), "%d" % dist, fill="black")
+    for r, (nbikes, ndocks) in enumerate(table.index):
+        draw.text((6, top + r * cell + cell // 2 - 6), "%d, %d" % (nbikes, ndocks), fill="black")
+        for c in range(cols):
+            cost = costs[r, c]
+            if cost != cost:
+                color = (160, 160, 160)
+            else:
+                share = cost / highest
+                color = (int(255 * share), int(200 * (1 - share)), 60)
+            box = (left + c * cell, top + r * cell, left + (c + 1) * cell - 2, top + (r + 1) * cell - 2)
+            draw.rectangle(box, fill=color)
+    return to_png(image)
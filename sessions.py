@@ -0,0 +1,143 @@
+import io
+import os
+import re
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+import data as dt
+import files
+
+
+# The columns of the stations that are saved: their coordinates and their names, if known.
+STATION_COLUMNS = ["lat", "lon", "name"]
+
+
+# Returns the index and the numeric and text columns of the dataframe as arrays (see frame_from_arrays).
+def frame_arrays(frame):
+    arrays = {"index": frame.index.to_numpy()}
+    for column in frame.columns:
+        if pd.api.types.is_numeric_dtype(frame[column]):
+            arrays["column_" + column] = frame[column].to_numpy()
+        elif pd.api.types.is_string_dtype(frame[column]):
+            arrays["column_" + column] = frame[column].to_numpy().astype(str)
+    return arrays
+
+
+# Returns the dataframe of the arrays of frame_arrays, indexed by station_id.
+def frame_from_arrays(arrays):
+    columns = {name[len("column_"):]: arrays[name] for name in arrays if name.startswith("column_")}
+    return pd.DataFrame(columns, index=pd.Index(arrays["index"], name='station_id'))
+
+
+# Returns the dataframe as the content of a .npz file, or None if there is no dataframe.
+def frame_bytes(frame):
+    if frame is None:
+        return None
+    buffer = io.BytesIO()
+    np.savez(buffer, **frame_arrays(frame))
+    return buffer.getvalue()
+
+
+def frame_from_bytes(content):
+    if content is None:
+        return None
+    with np.load(io.BytesIO(content)) as f:
+        return frame_from_arrays(dict(f))
+
+
+# Writes the dataframe to the given file unless it is already there, along with the other
+# given arrays, if any.
+def write_frame(path, frame, **arrays):
+    if os.path.isfile(path):
+        return
+    with files.replacing(path, ".npz") as tmp:
+        np.savez(tmp, **frame_arrays(frame), **arrays)
+
+
+def read_frame(path):
+    with np.load(path) as f:
+        return frame_from_arrays(dict(f))
+
+
+# Writes the snapshot to the given directory, as the files of its stations and of its bikes
+# (with the time they were updated, if known), unless they are already there.
+def write_snapshot(directory, snap):
+    columns = [column for column in STATION_COLUMNS if column in snap.stations.columns]
+    write_frame(os.path.join(directory, "stations_%d.npz" % snap.stations_version), snap.stations[columns])
+    times = dict() if snap.last_updated is None else {"last_updated": np.int64(snap.last_updated)}
+    write_frame(os.path.join(directory, "bikes_%d.npz" % snap.version), snap.bikes, **times)
+
+
+# Returns the snapshot with the given versions written by write_snapshot. The stations of
+# "previous" (another snapshot) are reused if they are the same.
+def read_snapshot(directory, version, stations_version, previous=None):
+    if previous is not None and previous.stations_version == stations_version:
+        stations = previous.stations
+    else:
+        stations = read_frame(os.path.join(directory, "stations_%d.npz" % stations_version))
+    with np.load(os.path.join(directory, "bikes_%d.npz" % version)) as f:
+        arrays = dict(f)
+    last_updated = int(arrays["last_updated"]) if "last_updated" in arrays else None
+    return dt.Snapshot(version, stations_version, stations, frame_from_arrays(arrays), last_updated)
+
+
+# Deletes the files of the snapshots of the directory except the ones with the given versions.
+def prune_snapshots(directory, versions, stations_versions):
+    for name in os.listdir(directory):
+        match = re.match(r"(stations|bikes)_(\d+)", name)
+        if match and int(match.group(2)) not in (stations_versions if match.group(1) == "stations" else versions):
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass  # deleted by another process
+
+
+# The sessions of the users (the distance, the snapshot of the data and the bikes modified by
+# /distribute), kept in a SQLite database of the given directory along with the snapshots they
+# use, so that they are restored when the bot starts again. Only the coordinates and the names of
+# the stations and the numeric and text columns of the bikes are kept, which are the ones the bot uses.
+class SessionStore:
+
+    def __init__(self, directory="state"):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(directory, "sessions.sqlite"), check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS sessions
+                           (usr_id INTEGER PRIMARY KEY, dist REAL, version INTEGER, stations_version INTEGER,
+                            bikes BLOB)''')
+        self.db.commit()
+
+    # Saves the session of the given user, along with its snapshot if it is not saved yet.
+    def save(self, usr_id, session):
+        snap = session["snapshot"]
+        write_snapshot(self.directory, snap)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)",
+                            (usr_id, session["dist"], snap.version, snap.stations_version,
+                             frame_bytes(session["bikes"])))
+            self.db.commit()
+
+    # Returns the saved sessions by user. Users with the same snapshot share it, as before saving.
+    def load(self):
+        with self.lock:
+            rows = self.db.execute("SELECT usr_id, dist, version, stations_version, bikes FROM sessions").fetchall()
+
+        # The snapshots with the same stations share their dataframe, read only once
+        snapshots, latest, sessions = dict(), dict(), dict()
+        for usr_id, dist, version, stations_version, bikes in rows:
+            if version not in snapshots:
+                try:
+                    snapshots[version] = read_snapshot(self.directory, version, stations_version,
+                                                       latest.get(stations_version))
+                except OSError:
+                    continue  # the files of the snapshot are gone, so is the session
+                latest[stations_version] = snapshots[version]
+            sessions[usr_id] = {"dist": dist, "snapshot": snapshots[version], "bikes": frame_from_bytes(bikes)}
+        return sessions
+
+    # Deletes the files of the snapshots that no session uses.
+    def prune(self, sessions):
+        prune_snapshots(self.directory, set(session["snapshot"].version for session in sessions.values()),
+                        set(session["snapshot"].stations_version for session in sessions.values()))
@@ -0,0 +1,26 @@
+# Checks that starting the bot stays fast: importing its modules takes a few times as long as
+# importing pandas (measured in the same run, so that a slow machine does not fail the test) and
+# does not import the modules that only some commands need (see benchmark.py imports).
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import benchmark
+
+# How many times the import of pandas each module may take. Today data and bot take about twice.
+SLOWDOWN = 4
+
+
+@pytest.fixture(scope="module")
+def baseline():
+    return min(benchmark.import_time("pandas")[0] for _ in range(3))
+
+
+@pytest.mark.parametrize("module", sorted(benchmark.IMPORT_BUDGETS))
+def test_import_time(module, baseline):
+    runs = [benchmark.import_time(module) for _ in range(3)]
+    total, children, imported = min(runs, key=lambda run: run[0])
+    assert total <= SLOWDOWN * baseline, "importing %s takes %.0f ms, pandas %.0f ms" % (
+        module, total, baseline)
+    assert [name for name in benchmark.DEFERRED_IMPORTS if name in imported] == []